@@ -3,6 +3,12 @@ from dotenv import load_dotenv
 from loaders import *
 from filters import *
 from plotting import *
+from stats import StatsEngine
+from denylist import BITS_COLUMNS
+from sql_filters import sql_filter_dataset, FEATURES_VIEW
+from similarity import SimilarityIndex
+from geo import H3Index, INDEX_RESOLUTIONS
+import h3
 import plotly.express as px
 
 
@@ -12,28 +18,76 @@ px.set_mapbox_access_token(token)
 
 engine = create_engine(os.getenv("POSTGRES_CONNECTION_STRING"))
 
+# only these columns are read from the daily cache (filters, plots and the result table)
+APP_COLUMNS = ["address_gateway", "name_gateway", "owner", "location", "lat", "lon", "name_maker", "long_country", "first_block", "nonce",
+               "gain", "elevation", "n_witnessed", "total_witnessed", "min_distance", "max_distance", "med_distance",
+               "avg_tx_reward_scale", "std_tx_reward_scale", "n_denylisted_tx", "same_maker_ratio", "avg_tx_age_blocks",
+               "std_tx_first_block", "r2_rssi_distance", "slope_rssi_distance", "r2_rssi_snr", "slope_rssi_snr",
+               "skew_rssi", "skew_snr", "packets_transferred", "rx_on_denylist", "denied_at_some_point", "cluster"] + BITS_COLUMNS
+
 
 @st.experimental_memo(ttl=86400)
 def load_data(_engine):
-    dataset = load_dataset(_engine)
-    baseline_df = dataset.sample(10000) # cache a baseline for comparison
-    hotspots_per_account = pd.DataFrame(dataset.groupby("owner").size())
+    # the block count doesn't depend on the dataset, so it's queried while the dataset loads
+    with ThreadPoolExecutor(1) as pool:
+        n_blocks = pool.submit(timed, "n_blocks", lambda: _engine.execute(n_blocks_sql).one()[0])
+        dataset = load_dataset(_engine, incremental=os.getenv("INCREMENTAL_REFRESH", "false").lower() == "true", columns=APP_COLUMNS)
+        n_blocks_in_dataset = n_blocks.result()
+    baseline_positions = np.sort(np.random.choice(len(dataset), min(10000, len(dataset)), replace=False))
+    baseline_df = dataset.iloc[baseline_positions] # cache a baseline for comparison
+    hotspots_per_account = pd.DataFrame(dataset.groupby("owner", observed=True).size())
     options = get_form_config(dataset)
     options.countries.insert(0,"All")
     options.makers.insert(0,"All")
 
-    n_blocks_in_dataset = _engine.execute(n_blocks_sql).one()[0]
-    return dataset, baseline_df, hotspots_per_account, options, n_blocks_in_dataset
+    # sorted numeric columns and categorical / flag bitmaps for the filters, built once per loaded dataset
+    filter_index = FilterIndex(dataset)
+    bitmaps = BitmapIndex(dataset)
+    spatial_index = H3Index(dataset)
+
+    # histogram bin edges fixed on the full dataset; the baseline side of every comparison is summarized once here
+    stats_engine = StatsEngine(dataset)
+    baseline_stats = stats_engine.summarize(baseline_positions)
+
+    # nearest neighbors over the standardized clustering features, for the similar hotspots query mode
+    similarity_index = SimilarityIndex(dataset)
+
+    # cached filter results are only valid for the dataset they were computed on. every projected column is hashed,
+    # so a reload with the same hotspots but new metrics, flags or denylist bits gets a new version
+    dataset_version = str(pd.util.hash_pandas_object(dataset, index=False).sum())
+
+    # release tags in the bit order the cache was built with, for the denylist history filters. caches without the
+    # bitsets get none
+    denylist_tags = load_denylist_tags() if BITS_COLUMNS[0] in dataset.columns else []
+
+    return dataset, baseline_df, hotspots_per_account, options, n_blocks_in_dataset, filter_index, bitmaps, dataset_version, \
+        stats_engine, baseline_stats, denylist_tags, similarity_index, spatial_index
 
 
-dataset, baseline_df, hotspots_per_account, options, n_blocks_in_dataset = load_data(engine)
+@st.experimental_singleton
+def get_result_cache():
+    # shared across sessions, so repeat queries from any analyst are served from memory
+    return FilterResultCache()
+
+
+dataset, baseline_df, hotspots_per_account, options, n_blocks_in_dataset, filter_index, bitmaps, dataset_version, \
+    stats_engine, baseline_stats, denylist_tags, similarity_index, spatial_index = load_data(engine)
+result_cache = get_result_cache()
 
 st.title("Hotspot POC Filtering")
 st.markdown(f"""This tool is useful for combing through the entire hotspot population based on common metrics related to POC.
 Results, which are refreshed daily, are based on challenge receipts and data transfer metrics for the last `{n_blocks_in_dataset}` blocks.
 See [`helium-transaction-etl`](https://github.com/evandiewald/helium-transaction-etl).""")
 
+query_mode = st.radio("Query Mode", ["Filters", "Similar Hotspots"])
+
 with st.form("filters_form") as form:
+    if query_mode == "Similar Hotspots":
+        similar_to = st.text_input("Hotspot address", help="Finds the hotspots whose POC metrics are closest to this one's. "
+                                                           "The filters below are ignored in this mode.")
+        n_similar = st.slider("Number of similar hotspots", min_value=10, max_value=1000, value=100, step=10)
+        exact_search = st.checkbox("Exact search (slower)")
+
     # makers
     with st.expander("Makers"):
         makers = st.multiselect("Manufacturer(s)", options=options.makers, default="All")
@@ -44,6 +98,12 @@ with st.form("filters_form") as form:
     with st.expander("Countries"):
         countries = st.multiselect("Countries", options=options.countries, default="All")
 
+    # mixture model clusters, when the cache was labeled
+    cluster_options = sorted(dataset["cluster"].unique().tolist()) if "cluster" in dataset.columns else []
+    with st.expander("Clusters"):
+        clusters = st.multiselect("Cluster(s)", options=cluster_options, default=cluster_options, disabled=not cluster_options,
+                                  help="Labels from the hotspot mixture model (clustering_gmm.py). -1 marks incomplete rows.")
+
     # data transfer
     with st.expander("Data Transfer"):
         data_transfer_opts = st.radio("Data Transfer", ["Data Transferring Hotspots ONLY", "NO Data Transferring Hotspots ONLY", "Custom Range"],
@@ -52,6 +112,15 @@ with st.form("filters_form") as form:
         data_transfer_range = st.slider("Select percentile range of data transferring hotspots",
                                         min_value=0, max_value=100, value=(0, 100), step=1, disabled=data_transfer_slider_disabled)
 
+    # location
+    with st.expander("Location"):
+        center = st.text_input("Center: a hotspot address, or lat, lon")
+        radius_km = st.number_input("Only include hotspots within this many km of the center (0 = off)", value=0.0, min_value=0.0)
+        k_ring_size = st.number_input("Only include hotspots within this many hexes of the center's hex (0 = off)", value=0, min_value=0)
+        k_ring_resolution = st.select_slider("Hex resolution for neighboring hexes", options=INDEX_RESOLUTIONS, value=8)
+        min_hex_density = st.number_input("Only include hotspots in hexes with at least this many hotspots (0 = off)", value=0, min_value=0)
+        hex_density_resolution = st.select_slider("Hex resolution for density", options=INDEX_RESOLUTIONS, value=8)
+
     # witnessing numbers
     # with st.expander("Witness Counts"):
     #     n_witnessed_range = st.slider("Select percentile range of number of unique witnesses.",
@@ -107,14 +176,48 @@ with st.form("filters_form") as form:
         never_denied = st.checkbox("Only include hotspots that have never been denied.", disabled=on_current_denylist)
         # witnesses a denylisted transmitter
         witnesses_denylisted_tx = st.checkbox("Only include hotspots that have witnessed a denylisted hotspot.")
+        # release history, from the per-hotspot release bitsets
+        release_range_enabled = st.checkbox("Only include hotspots denied in a range of denylist releases.", disabled=not denylist_tags)
+        denied_release_range = st.select_slider("Denylist releases", options=denylist_tags or ["None"],
+                                                value=(denylist_tags[0], denylist_tags[-1]) if denylist_tags else "None",
+                                                disabled=not denylist_tags)
+        first_denied_after = st.selectbox("Only include hotspots first denied AFTER release", ["Any"] + denylist_tags,
+                                          disabled=not denylist_tags)
 
     categorize_by = st.radio("Categorize Plots by", ["Denylist Status", "Manufacturer"])
     display_df = st.checkbox("Show Result Set Dataframe")
     display_plots = st.checkbox("Show plots")
+    live_query = st.checkbox("Query the latest summary views in the database",
+                             help="Runs the filters in postgres against the hotspot_features view instead of the daily snapshot. "
+                                  "The view is as fresh as its last refresh (views.py --refresh).")
+    rendering = st.radio("Map Rendering", ["Automatic", "Raw Points", "Aggregated"],
+                         help=f"Aggregated maps bin hotspots into hexes on the server (histograms are always binned there). "
+                              f"Automatic aggregates above {AGGREGATE_THRESHOLD} results.")
     submit = st.form_submit_button("Submit")
 
 
+def resolve_center(center: str):
+    # (lat, lon, h3 location) of a hotspot address or a "lat, lon" pair; None if it can't be resolved
+    center = center.strip()
+    if not center:
+        return None
+    matches = np.flatnonzero(dataset["address_gateway"].to_numpy() == center)
+    if len(matches):
+        row = dataset.iloc[matches[0]]
+        return row["lat"], row["lon"], row["location"]
+    try:
+        lat, lon = (float(x) for x in center.split(","))
+    except ValueError:
+        return None
+    return lat, lon, h3.geo_to_h3(lat, lon, max(INDEX_RESOLUTIONS))
+
+
 if submit:
+    resolved_center = resolve_center(center)
+    if center.strip() and resolved_center is None:
+        st.error("Location center must be a hotspot address in the dataset or a \"lat, lon\" pair.")
+        st.stop()
+
     filters = Filters(
         makers=makers,
         countries=countries,
@@ -141,16 +244,58 @@ if submit:
         on_current_denylist=on_current_denylist,
         on_any_denylist=on_any_denylist,
         previously_denied=previously_denied,
-        never_denied=never_denied
+        never_denied=never_denied,
+        denied_release_range=(denylist_tags.index(denied_release_range[0]), denylist_tags.index(denied_release_range[1]))
+        if release_range_enabled else None,
+        first_denied_after=denylist_tags.index(first_denied_after) if first_denied_after != "Any" else None,
+        clusters=clusters if cluster_options and set(clusters) != set(cluster_options) else None,
+        radius_center=resolved_center[:2] if resolved_center and radius_km > 0 else None,
+        radius_km=radius_km if resolved_center and radius_km > 0 else None,
+        k_ring_center=resolved_center[2] if resolved_center and k_ring_size > 0 else None,
+        k_ring_size=k_ring_size if resolved_center and k_ring_size > 0 else None,
+        k_ring_resolution=k_ring_resolution,
+        min_hex_density=min_hex_density if min_hex_density > 0 else None,
+        hex_density_resolution=hex_density_resolution
     )
-    filtered_df = filter_dataset(dataset, filters)
-
-    filtered_df["source"] = "filtered"
-    baseline_df["source"] = "baseline"
-    plot_df = pd.concat([filtered_df, baseline_df])
+    if query_mode == "Similar Hotspots":
+        matches = np.flatnonzero(dataset["address_gateway"].to_numpy() == similar_to.strip())
+        if len(matches) == 0:
+            st.error("Hotspot not found in the dataset.")
+            st.stop()
+        positions, _ = similarity_index.query(matches[0], k=n_similar, exact=exact_search)
+        filtered_df = dataset.iloc[positions]
+    elif live_query:
+        filtered_df = sql_filter_dataset(engine, filters, APP_COLUMNS, release_tags=denylist_tags)
+        freshness = summary_freshness(engine)
+        if FEATURES_VIEW in freshness.index:
+            st.caption(f"Live results as of the last `{FEATURES_VIEW}` refresh, {freshness.loc[FEATURES_VIEW, 'refreshed_at']}.")
+        else:
+            st.caption(f"`{FEATURES_VIEW}` has no recorded refresh; results may be stale.")
+    else:
+        positions = result_cache.positions(dataset, filters, dataset_version, filter_index, bitmaps, spatial_index)
+        filtered_df = dataset.iloc[positions]
 
     n_results = len(filtered_df)
+    aggregate = rendering == "Aggregated" or (rendering == "Automatic" and n_results > AGGREGATE_THRESHOLD)
+
+    # one pass over the selected rows summarizes every compared feature for the charts and metric tiles, in both
+    # rendering modes (live results aren't rows of the snapshot, so their frame is binned against the same edges)
+    filtered_stats = stats_engine.summarize_frame(filtered_df) if live_query and query_mode == "Filters" else \
+        stats_engine.summarize(positions)
+
+    def histogram(on_key):
+        if on_key in filtered_stats:
+            return plot_comparison_histogram(filtered_stats, baseline_stats, on_key)
+        return plot_histogram_aggregated(filtered_df, baseline_df, on_key)
+
+    def comparison(subheader, on_key):
+        st.subheader(subheader)
+        st.plotly_chart(histogram(on_key))
+        if n_results > 0 and on_key in filtered_stats:
+            generate_comparison_metrics(filtered_stats, baseline_stats, on_key)
+
     st.metric("Number of Hotspots in Subset", value=n_results)
+    st.caption(f"Result cache: {result_cache.hits} hits / {result_cache.misses} misses")
 
     with st.spinner("Generating Plots..."):
         if n_results > 100e3:
@@ -176,42 +321,35 @@ if submit:
                 st.plotly_chart(plot_denylist_breakdown(filtered_df, baseline_df))
 
                 st.subheader("Hotspot Locations")
-                st.plotly_chart(plot_hotspot_locations(filtered_df, color_key))
+                if aggregate:
+                    st.plotly_chart(plot_hotspot_hexbins(filtered_df, color_key))
+                else:
+                    st.plotly_chart(plot_hotspot_locations(filtered_df, color_key))
 
                 st.subheader("Ownership Patterns")
                 st.plotly_chart(plot_ownership_breakdown(filtered_df, hotspots_per_account))
 
-                st.subheader("Witness Counts")
-                st.plotly_chart(plot_histogram(plot_df, "n_witnessed"))
+                comparison("Witness Counts", "n_witnessed")
 
-                st.subheader("Witness Distances")
-                st.plotly_chart(plot_histogram(plot_df, "med_distance"))
+                comparison("Witness Distances", "med_distance")
 
                 st.subheader("Data Transfer")
-                st.plotly_chart(plot_data_transfer(filtered_df, baseline_df))
+                st.plotly_chart(plot_data_transfer_comparison(filtered_stats, baseline_stats))
 
-                st.subheader("Reward Scales of Witnessed")
-                st.plotly_chart(plot_histogram(plot_df, "avg_tx_reward_scale"))
+                comparison("Reward Scales of Witnessed", "avg_tx_reward_scale")
 
-                st.subheader("Same-Maker Witnessing")
-                st.plotly_chart(plot_histogram(plot_df, "same_maker_ratio"))
+                comparison("Same-Maker Witnessing", "same_maker_ratio")
 
-                st.subheader("Age of Witnessed Hotspots")
-                st.plotly_chart(plot_histogram(plot_df, "avg_tx_age_blocks"))
+                comparison("Age of Witnessed Hotspots", "avg_tx_age_blocks")
 
-                st.subheader("Variability in Age of Witnessed Hotspots")
-                st.plotly_chart(plot_histogram(plot_df, "std_tx_first_block"))
+                comparison("Variability in Age of Witnessed Hotspots", "std_tx_first_block")
 
-                st.subheader("RSSI vs Distance R2")
-                st.plotly_chart(plot_histogram(plot_df, "r2_rssi_distance"))
+                comparison("RSSI vs Distance R2", "r2_rssi_distance")
 
-                st.subheader("RSSI vs Distance Slope")
-                st.plotly_chart(plot_histogram(plot_df, "slope_rssi_distance"))
+                comparison("RSSI vs Distance Slope", "slope_rssi_distance")
 
-                st.subheader("RSSI vs SNR R2")
-                st.plotly_chart(plot_histogram(plot_df, "r2_rssi_snr"))
+                comparison("RSSI vs SNR R2", "r2_rssi_snr")
 
-                st.subheader("RSSI vs Distance Slope")
-                st.plotly_chart(plot_histogram(plot_df, "slope_rssi_snr"))
+                comparison("RSSI vs Distance Slope", "slope_rssi_snr")
 
 
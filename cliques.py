@@ -0,0 +1,108 @@
+import numpy as np
+import time
+from typing import List, Optional, Tuple
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def _degeneracy_order(adjacency: List[int]) -> List[int]:
+    # repeatedly remove a minimum-degree vertex; returns vertices highest core first
+    remaining = (1 << len(adjacency)) - 1
+    degree = [bin(a).count("1") for a in adjacency]
+    removed = []
+    while remaining:
+        v = min((i for i in range(len(adjacency)) if remaining >> i & 1), key=lambda i: degree[i])
+        removed.append(v)
+        remaining &= ~(1 << v)
+        neighbors = adjacency[v] & remaining
+        while neighbors:
+            u = (neighbors & -neighbors).bit_length() - 1
+            degree[u] -= 1
+            neighbors &= neighbors - 1
+    return removed[::-1]
+
+
+def _color_sort(candidates: int, adjacency: List[int]) -> Tuple[List[int], List[int]]:
+    # greedy coloring in bit order (= degeneracy order). a clique can't contain two vertices of the same color,
+    # so the color number is an upper bound on how much any branch can still add
+    order, colors = [], []
+    uncolored = candidates
+    color = 0
+    while uncolored:
+        color += 1
+        available = uncolored
+        while available:
+            v = (available & -available).bit_length() - 1
+            available &= ~adjacency[v] & ~(1 << v)
+            uncolored &= ~(1 << v)
+            order.append(v)
+            colors.append(color)
+    return order, colors
+
+
+def max_clique(adjacency: List[int], time_budget: Optional[float] = None) -> Tuple[List[int], bool]:
+    # branch and bound maximum clique (MCQ-style coloring bound) over a graph given as one neighbor bitset per
+    # vertex. returns (vertices, exact); when the time budget runs out the best clique so far is a lower bound
+    n = len(adjacency)
+    if n == 0:
+        return [], True
+
+    # relabel so bit position follows degeneracy order
+    ordering = _degeneracy_order(adjacency)
+    position = {v: i for i, v in enumerate(ordering)}
+    relabeled = [0] * n
+    for v, neighbors in enumerate(adjacency):
+        bits = 0
+        while neighbors:
+            u = (neighbors & -neighbors).bit_length() - 1
+            bits |= 1 << position[u]
+            neighbors &= neighbors - 1
+        relabeled[position[v]] = bits
+
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    best = [[0]]
+
+    def expand(clique: List[int], candidates: int):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _OutOfTime
+        order, colors = _color_sort(candidates, relabeled)
+        for v, color in zip(reversed(order), reversed(colors)):
+            if len(clique) + color <= len(best[0]):
+                return
+            extended = clique + [v]
+            remaining = candidates & relabeled[v]
+            if remaining:
+                expand(extended, remaining)
+            elif len(extended) > len(best[0]):
+                best[0] = extended
+            candidates &= ~(1 << v)
+
+    exact = True
+    try:
+        expand([], (1 << n) - 1)
+    except _OutOfTime:
+        exact = False
+    return [ordering[v] for v in best[0]], exact
+
+
+def largest_clique_containing(graph, node: int, time_budget: Optional[float] = None) -> Tuple[np.ndarray, bool]:
+    # largest clique containing `node` in its 2-hop graph. every such clique lies inside the node's first hop, so
+    # the search only looks at the subgraph induced on those neighbors instead of enumerating all maximal cliques.
+    # returns (node ids including `node`, exact)
+    neighbors = graph.first_hop(node)
+    local = {v: i for i, v in enumerate(neighbors)}
+
+    adjacency = []
+    undirected = graph.undirected
+    for v in neighbors:
+        bits = 0
+        for u in undirected.indices[undirected.indptr[v]:undirected.indptr[v + 1]]:
+            i = local.get(u)
+            if i is not None:
+                bits |= 1 << i
+        adjacency.append(bits)
+
+    members, exact = max_clique(adjacency, time_budget)
+    return np.concatenate([[node], neighbors[members]]).astype(int), exact
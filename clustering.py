@@ -0,0 +1,143 @@
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import joblib
+import os
+from typing import Iterator, List, Optional
+from sklearn.preprocessing import StandardScaler
+
+
+MODEL_PATH = "static/clustering/hotspot_clusters.joblib"
+
+# the numeric features clustering_gmm.py has always clustered on (every cache column it didn't drop)
+CLUSTER_FEATURES = ["n_witnessed", "total_witnessed", "min_distance", "max_distance", "avg_tx_reward_scale",
+                    "std_tx_reward_scale", "r2_rssi_distance", "slope_rssi_distance", "r2_rssi_snr", "slope_rssi_snr",
+                    "skew_rssi", "skew_snr", "same_maker_ratio", "avg_tx_age_blocks", "std_tx_first_block", "gain",
+                    "elevation", "transferred_data"]
+
+
+def feature_matrix(df: pd.DataFrame, features: List[str] = CLUSTER_FEATURES) -> np.ndarray:
+    columns = {f: df[f].to_numpy(dtype=float) for f in features if f != "transferred_data"}
+    if "transferred_data" in features:
+        columns["transferred_data"] = (df["packets_transferred"].to_numpy() > 0).astype(float)
+    return np.column_stack([columns[f] for f in features])
+
+
+def iter_cache_batches(path: str, features: List[str] = CLUSTER_FEATURES, batch_size: int = 50000) -> Iterator[np.ndarray]:
+    # feature rows straight from the parquet cache, batch_size at a time; rows with missing values are skipped
+    columns = [f for f in features if f != "transferred_data"] + (["packets_transferred"] if "transferred_data" in features else [])
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+        X = feature_matrix(batch.to_pandas(), features)
+        yield X[np.isfinite(X).all(axis=1)]
+
+
+class OnlineGaussianMixture:
+    # diagonal-covariance gaussian mixture fit by stepwise EM: each mini-batch's expected sufficient statistics are
+    # blended into running averages with step size (t + 2) ** -decay, so memory doesn't grow with the data
+
+    def __init__(self, n_components: int = 6, decay: float = 0.7, reg_covar: float = 1e-3, random_state: int = 0):
+        self.n_components = n_components
+        self.decay = decay
+        self.reg_covar = reg_covar
+        self.random = np.random.default_rng(random_state)
+        self.n_steps = 0
+        self.weights_ = self.means_ = self.variances_ = None
+
+    def _log_prob(self, X: np.ndarray) -> np.ndarray:
+        # (n, k) log weight + log density of each component
+        precision = 1 / self.variances_
+        squared = (X ** 2) @ precision.T - 2 * X @ (self.means_ * precision).T + (self.means_ ** 2 * precision).sum(axis=1)
+        log_det = np.log(2 * np.pi * self.variances_).sum(axis=1)
+        return np.log(self.weights_) - 0.5 * (squared + log_det)
+
+    def _responsibilities(self, X: np.ndarray):
+        log_prob = self._log_prob(X)
+        log_norm = np.logaddexp.reduce(log_prob, axis=1)
+        return np.exp(log_prob - log_norm[:, None]), log_norm
+
+    def _initialize(self, X: np.ndarray):
+        # k-means++ seeding of the means on the first batch, shared batch variance, equal weights
+        sample = X[self.random.choice(len(X), min(len(X), 10000), replace=False)]
+        means = [sample[self.random.integers(len(sample))]]
+        distance = ((sample - means[0]) ** 2).sum(axis=1)
+        for _ in range(1, self.n_components):
+            p = distance / distance.sum() if distance.sum() > 0 else None
+            means.append(sample[self.random.choice(len(sample), p=p)])
+            distance = np.minimum(distance, ((sample - means[-1]) ** 2).sum(axis=1))
+        self.means_ = np.array(means)
+        self.variances_ = np.tile(X.var(axis=0) + self.reg_covar, (self.n_components, 1))
+        self.weights_ = np.full(self.n_components, 1 / self.n_components)
+        self._s0 = self.weights_.copy()
+        self._s1 = self.weights_[:, None] * self.means_
+        self._s2 = self.weights_[:, None] * (self.variances_ + self.means_ ** 2)
+
+    def partial_fit(self, X: np.ndarray):
+        if len(X) == 0:
+            return self
+        if self.means_ is None:
+            self._initialize(X)
+
+        resp, _ = self._responsibilities(X)
+        step = (self.n_steps + 2) ** -self.decay
+        self._s0 = (1 - step) * self._s0 + step * resp.mean(axis=0)
+        self._s1 = (1 - step) * self._s1 + step * resp.T @ X / len(X)
+        self._s2 = (1 - step) * self._s2 + step * resp.T @ (X ** 2) / len(X)
+        self.n_steps += 1
+
+        s0 = np.maximum(self._s0, 1e-12)
+        self.weights_ = s0 / s0.sum()
+        self.means_ = self._s1 / s0[:, None]
+        self.variances_ = np.maximum(self._s2 / s0[:, None] - self.means_ ** 2, 0) + self.reg_covar
+        return self
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        return self._responsibilities(X)[0]
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self._log_prob(X).argmax(axis=1)
+
+    def score(self, X: np.ndarray) -> float:
+        # average log-likelihood per row
+        return float(self._responsibilities(X)[1].mean())
+
+
+class HotspotClusters:
+    # scaler + mixture over CLUSTER_FEATURES, fit from cache batches and persisted together
+
+    def __init__(self, n_components: int = 6, features: List[str] = CLUSTER_FEATURES, random_state: int = 0):
+        self.features = features
+        self.scaler = StandardScaler()
+        self.model = OnlineGaussianMixture(n_components, random_state=random_state)
+        self.random = np.random.default_rng(random_state)
+
+    def fit_cache(self, path: str, batch_size: int = 50000, epochs: int = 5):
+        # one pass for the scaler's running mean / variance, then `epochs` passes of stepwise EM over shuffled batches
+        for X in iter_cache_batches(path, self.features, batch_size):
+            self.scaler.partial_fit(X)
+        for epoch in range(epochs):
+            for X in iter_cache_batches(path, self.features, batch_size):
+                self.model.partial_fit(self.scaler.transform(X[self.random.permutation(len(X))]))
+        return self
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        # one vectorized pass; rows with missing features get -1
+        X = feature_matrix(df, self.features)
+        complete = np.isfinite(X).all(axis=1)
+        labels = np.full(len(df), -1, dtype=np.int8)
+        labels[complete] = self.model.predict(self.scaler.transform(X[complete]))
+        return labels
+
+    def save(self, path: str = MODEL_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path: str = MODEL_PATH) -> "HotspotClusters":
+        return joblib.load(path)
+
+
+def label_dataset(dataset: pd.DataFrame, path: str = MODEL_PATH) -> Optional[np.ndarray]:
+    # cluster labels from the persisted model, or None if no model has been fit yet
+    if not os.path.exists(path):
+        return None
+    return HotspotClusters.load(path).predict(dataset)
@@ -0,0 +1,95 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import os
+import json
+from typing import List, Optional
+
+
+# dtype contract for the daily dataset cache. anything not listed is written as-is (mostly address / name strings)
+CATEGORICAL_COLUMNS = ["name_maker", "long_country", "owner"]
+
+DATASET_DTYPES = {
+    "n_witnessed": "int64",
+    "total_witnessed": "int64",
+    "min_distance": "float64",
+    "max_distance": "float64",
+    "avg_tx_reward_scale": "float64",
+    "std_tx_reward_scale": "float64",
+    "n_denylisted_tx": "int64",
+    "r2_rssi_distance": "float64",
+    "slope_rssi_distance": "float64",
+    "r2_rssi_snr": "float64",
+    "slope_rssi_snr": "float64",
+    "skew_rssi": "float64",
+    "skew_snr": "float64",
+    "same_maker_ratio": "float64",
+    "avg_tx_age_blocks": "float64",
+    "std_tx_first_block": "float64",
+    "rx_on_denylist": "int8",
+    "first_block": "int64",
+    "last_block": "int64",
+    "nonce": "int64",
+    "gain": "float64",
+    "elevation": "float64",
+    "reward_scale": "float64",
+    "lat": "float64",
+    "lon": "float64",
+    "dcs_transferred": "int64",
+    "packets_transferred": "int64",
+    "denied_at_some_point": "bool",
+    "cluster": "int8",
+    **{c: "category" for c in CATEGORICAL_COLUMNS},
+}
+
+
+def cache_path(date_str: str, extension: str = "parquet") -> str:
+    return f"static/cache_{date_str}.{extension}"
+
+
+def apply_schema(dataset: pd.DataFrame) -> pd.DataFrame:
+    dtypes = {c: t for c, t in DATASET_DTYPES.items() if c in dataset.columns}
+
+    # csv caches round-trip booleans as strings when a column had mixed values
+    if "denied_at_some_point" in dtypes and dataset["denied_at_some_point"].dtype == object:
+        dataset["denied_at_some_point"] = dataset["denied_at_some_point"].map({"True": True, "False": False, True: True, False: False})
+
+    return dataset.astype(dtypes)
+
+
+def write_dataset_cache(dataset: pd.DataFrame, path: str):
+    if os.path.isdir(os.path.dirname(path)) is False:
+        os.mkdir(os.path.dirname(path))
+    dataset.to_parquet(path, index=False)
+
+
+def read_dataset_cache(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    # projected read: only the requested columns that actually exist in the file are decoded
+    if columns is not None:
+        available = set(pq.read_schema(path).names)
+        columns = [c for c in columns if c in available]
+    return pd.read_parquet(path, columns=columns)
+
+
+def denylist_tags_path(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}.denylist_tags.json"
+
+
+def write_denylist_tags(tags: List[str], path: str):
+    # the release tags in the bit order the cache's denylist_bits_ columns were built with, next to the cache itself
+    with open(denylist_tags_path(path), "w") as f:
+        json.dump(tags, f)
+
+
+def read_denylist_tags(path: str) -> List[str]:
+    # empty for caches written without the bitsets, so the release filters stay disabled
+    if not os.path.exists(denylist_tags_path(path)):
+        return []
+    with open(denylist_tags_path(path)) as f:
+        return json.load(f)
+
+
+def migrate_csv_cache(csv_path: str, parquet_path: str):
+    # convert an existing static/cache_YYYY-MM-DD.csv.gz so older caches keep working after the format change
+    print(f"Migrating {csv_path} to {parquet_path}...")
+    dataset = pd.read_csv(csv_path, index_col=0)
+    write_dataset_cache(apply_schema(dataset), parquet_path)
@@ -0,0 +1,172 @@
+import json
+import os
+import tempfile
+import requests
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+
+RELEASES_URL = "https://api.github.com/repos/helium/denylist/releases"
+RELEASE_CSV_URL = "https://raw.githubusercontent.com/helium/denylist/{tag}/denylist.csv"
+
+# per-hotspot release membership: release i (oldest first) is bit i % 64 of column denylist_bits_{i // 64}
+BITS_PREFIX = "denylist_bits_"
+MAX_RELEASES = 256
+BITS_COLUMNS = [f"{BITS_PREFIX}{i}" for i in range(MAX_RELEASES // 64)]
+
+
+def parse_release(text: str) -> List[str]:
+    # a release is one address per line, each followed by a trailing comma
+    return [line.split(",")[0].strip() for line in text.splitlines() if line.split(",")[0].strip()]
+
+
+class DenylistStore:
+    # local copy of every denylist release under `directory`: one csv per tag plus a manifest with the release list
+    # and its ETag. releases never change once tagged, so a sync only downloads tags that aren't on disk yet. urls are
+    # configurable so the store can be pointed at a local http server
+
+    def __init__(self, directory: str = "static/denylist", releases_url: str = RELEASES_URL,
+                 release_csv_url: str = RELEASE_CSV_URL, offline: bool = False, workers: int = 8, timeout: float = 30):
+        self.directory = directory
+        self.releases_url = releases_url
+        self.release_csv_url = release_csv_url
+        self.offline = offline
+        self.workers = workers
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(directory=os.getenv("DENYLIST_DIR", "static/denylist"),
+                   releases_url=os.getenv("DENYLIST_RELEASES_URL", RELEASES_URL),
+                   release_csv_url=os.getenv("DENYLIST_RELEASE_CSV_URL", RELEASE_CSV_URL),
+                   offline=os.getenv("DENYLIST_OFFLINE", "false").lower() == "true")
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, "releases.json")
+
+    def release_path(self, tag: str) -> str:
+        return os.path.join(self.directory, f"{tag}.csv")
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"etag": None, "releases": []}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict):
+        # a unique temp file per writer, so concurrent syncs of the same directory can't rename each other's
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path)
+
+    def list_releases(self) -> List[dict]:
+        # releases oldest first, as {"tag", "published_at"}. a conditional request answers 304 when nothing was
+        # released since the last sync; offline or on failure, the manifest from the last successful sync is used
+        manifest = self._read_manifest()
+        if self.offline:
+            return manifest["releases"]
+
+        headers = {"If-None-Match": manifest["etag"]} if manifest["etag"] else {}
+        try:
+            r = requests.get(self.releases_url, params={"per_page": 100}, headers=headers, timeout=self.timeout)
+            if r.status_code == 304:
+                return manifest["releases"]
+            r.raise_for_status()
+            etag, pages = r.headers.get("ETag"), r.json()
+            while "next" in r.links:
+                r = requests.get(r.links["next"]["url"], timeout=self.timeout)
+                r.raise_for_status()
+                pages += r.json()
+        except requests.RequestException as e:
+            print(f"Couldn't list denylist releases ({e}), using the {len(manifest['releases'])} stored locally.")
+            return manifest["releases"]
+
+        releases = sorted(({"tag": p["tag_name"], "published_at": p.get("published_at") or ""} for p in pages),
+                          key=lambda p: p["published_at"])
+        self._write_manifest({"etag": etag, "releases": releases})
+        return releases
+
+    def _fetch_release(self, tag: str) -> Optional[str]:
+        try:
+            r = requests.get(self.release_csv_url.format(tag=tag), timeout=self.timeout)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Couldn't download denylist release {tag}: {e}")
+            return None
+        # write-then-rename so an interrupted download never leaves a partial release behind
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(r.text)
+        os.replace(tmp, self.release_path(tag))
+        return tag
+
+    def sync(self) -> List[str]:
+        # download missing releases concurrently; returns the tags available locally, oldest first
+        tags = [r["tag"] for r in self.list_releases()]
+        missing = [t for t in tags if not os.path.exists(self.release_path(t))]
+        if missing and not self.offline:
+            with ThreadPoolExecutor(self.workers) as pool:
+                list(pool.map(self._fetch_release, missing))
+        return [t for t in tags if os.path.exists(self.release_path(t))]
+
+    def tags(self) -> List[str]:
+        # stored releases in bit order, without syncing
+        return [r["tag"] for r in self._read_manifest()["releases"] if os.path.exists(self.release_path(r["tag"]))]
+
+    def read_release(self, tag: str) -> List[str]:
+        with open(self.release_path(tag)) as f:
+            return parse_release(f.read())
+
+    def releases(self) -> dict:
+        # tag -> addresses, oldest release first
+        return {tag: self.read_release(tag) for tag in self.sync()}
+
+    def denied_addresses(self) -> set:
+        # every address on any release, built in a single pass over the stored files
+        denied = set()
+        for tag in self.sync():
+            denied.update(self.read_release(tag))
+        return denied
+
+
+def release_membership(addresses: pd.Series, releases: dict) -> pd.DataFrame:
+    # uint64 bitset columns aligned with `addresses`, from one join of every (address, release) pair against the
+    # address index instead of a per-row set lookup
+    if len(releases) > MAX_RELEASES:
+        raise ValueError(f"{len(releases)} denylist releases don't fit in the {MAX_RELEASES} bits the cache keeps; "
+                         f"raise MAX_RELEASES")
+    n_words = max(1, (len(releases) + 63) // 64)
+    bits = np.zeros((len(addresses), n_words), dtype=np.uint64)
+    if releases:
+        listed = np.concatenate([np.asarray(a, dtype=object) for a in releases.values()])
+        release = np.repeat(np.arange(len(releases)), [len(a) for a in releases.values()])
+        rows = pd.Index(addresses).get_indexer(listed)
+        found = rows >= 0
+        rows, release = rows[found], release[found]
+        np.bitwise_or.at(bits, (rows, release // 64), np.left_shift(np.uint64(1), (release % 64).astype(np.uint64)))
+    return pd.DataFrame(bits, columns=[f"{BITS_PREFIX}{i}" for i in range(n_words)], index=addresses.index)
+
+
+def bits_columns(dataset: pd.DataFrame) -> List[str]:
+    return sorted((c for c in dataset.columns if c.startswith(BITS_PREFIX)), key=lambda c: int(c[len(BITS_PREFIX):]))
+
+
+def release_range_words(n_words: int, low: int, high: int) -> np.ndarray:
+    # per-word masks with bits low..high (inclusive) set
+    mask = (1 << (high + 1)) - (1 << low) if high >= low else 0
+    return np.array([(mask >> (64 * i)) & 0xFFFFFFFFFFFFFFFF for i in range(n_words)], dtype=np.uint64)
+
+
+def denied_in_releases(bits: np.ndarray, low: int, high: int) -> np.ndarray:
+    # on at least one release in low..high
+    return (bits & release_range_words(bits.shape[1], low, high)).any(axis=1)
+
+
+def first_denied_after(bits: np.ndarray, release: int) -> np.ndarray:
+    # on no release up to and including `release`, but on some later one
+    return ~denied_in_releases(bits, 0, release) & bits.any(axis=1)
@@ -0,0 +1,101 @@
+import pandas as pd
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from sqlalchemy.engine import Engine
+from queries import ego_graph_edges_sql, challenge_watermark_sql
+from witness_graph import WitnessGraph
+from cliques import largest_clique_containing
+from lru import LRUCache
+
+
+def calculate_ego_graph_metrics(address: str, engine: Engine, clique_time_budget: float = None):
+    edges = engine.execute(ego_graph_edges_sql, {"address": address}).all()
+
+    graph = WitnessGraph.from_edges(pd.DataFrame(edges, columns=["transmitter_address", "witness_address"]))
+    if address not in graph:
+        raise IndexError(address)
+    root = graph.ids([address])[0]
+    G = graph.ego_graph(address)
+
+    # cliques. past the time budget we return the largest clique found so far
+    clique_nodes, clique_exact = largest_clique_containing(graph, root, clique_time_budget)
+    largest_clique = list(graph.addresses[clique_nodes])
+
+    # clustering coefficient
+    clustering_coeff = graph.clustering([root])[0]
+
+    # degree
+    in_degree = int(graph.degree()[root])
+
+    return G, largest_clique, clique_exact, clustering_coeff, in_degree
+
+
+class EgoGraphService:
+    # LRU of computed 2-hop graphs keyed by (address, block epoch), so entries are invalidated every `epoch_blocks`
+    # blocks rather than on every new block. after a lookup the root's first-hop neighbors can be computed in the
+    # background, since they're usually the next addresses analysts look at
+
+    def __init__(self, engine: Engine, clique_time_budget: float = None, max_entries: int = 256,
+                 max_edges: int = 2_000_000, prefetch_workers: int = 2, max_prefetch: int = 20, foreground_workers: int = 4,
+                 watermark_ttl: float = 60, epoch_blocks: int = 60):
+        self.engine = engine
+        self.clique_time_budget = clique_time_budget
+        # bounded by total edges held, as a proxy for memory
+        self.cache = LRUCache(max_entries=max_entries, max_bytes=max_edges)
+        self.executor = ThreadPoolExecutor(prefetch_workers)
+        # foreground lookups get their own threads so they never queue behind prefetches
+        self.foreground = ThreadPoolExecutor(foreground_workers)
+        self.max_prefetch = max_prefetch
+        self.watermark_ttl = watermark_ttl
+        self.epoch_blocks = epoch_blocks
+        self._watermark = (None, 0.)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def watermark(self) -> int:
+        # max(block) rounded down to the epoch, re-read at most every `watermark_ttl` seconds. blocks arrive about once
+        # a minute, so keying on the raw block would miss on nearly every lookup
+        block, checked_at = self._watermark
+        if block is None or time.monotonic() - checked_at > self.watermark_ttl:
+            block = self.engine.execute(challenge_watermark_sql).one()[0]
+            self._watermark = (block, time.monotonic())
+        return block // self.epoch_blocks * self.epoch_blocks
+
+    def _compute(self, key: tuple):
+        result = calculate_ego_graph_metrics(key[0], self.engine, self.clique_time_budget)
+        self.cache.put(key, result, nbytes=result[0].number_of_edges())
+        return result
+
+    def _submit(self, key: tuple, foreground: bool = False) -> Future:
+        # one in-flight computation per key, shared by foreground lookups and prefetches
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = (self.foreground if foreground else self.executor).submit(self._compute, key)
+                self._pending[key] = future
+                future.add_done_callback(lambda _: self._forget(key))
+            return future
+
+    def _forget(self, key: tuple):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def get(self, address: str, prefetch: bool = True):
+        key = (address, self.watermark())
+        result = self.cache.get(key)
+        if result is None:
+            result = self._submit(key, foreground=True).result()
+
+        if prefetch:
+            self.prefetch(result[0], address, key[1])
+        return result
+
+    def prefetch(self, G, address: str, watermark: int):
+        for neighbor in list(G.neighbors(address))[:self.max_prefetch]:
+            key = (neighbor, watermark)
+            if key not in self.cache:
+                self._submit(key)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -2,6 +2,12 @@ import pandas as pd
 from typing import List, Union, Optional, Tuple
 from pydantic import BaseModel
 import numpy as np
+import hashlib
+import json
+from indexes import FilterIndex, BitmapIndex, popcount
+from lru import LRUCache
+from denylist import bits_columns, denied_in_releases, first_denied_after
+from geo import H3Index
 
 
 class Filters(BaseModel):
@@ -44,39 +50,306 @@ class Filters(BaseModel):
     previously_denied: bool = False
     never_denied: bool = False
 
+    # denylist release indices, oldest release = 0 (see denylist.release_membership)
+    denied_release_range: Optional[Tuple[int, int]]
+    first_denied_after: Optional[int]
 
-def filter_dataset(dataset: pd.DataFrame, filters: Filters) -> pd.DataFrame:
-    filtered = dataset[
-        (dataset["name_maker"].isin(filters.makers) if "All" not in filters.makers else True) &
-        (dataset["long_country"].isin(filters.countries) if "All" not in filters.countries else True) &
-        (dataset["packets_transferred"] > 0 if filters.data_transfer_opts == "Data Transferring Hotspots ONLY" else True) &
-        (dataset["packets_transferred"] == 0 if filters.data_transfer_opts == "NO Data Transferring Hotspots ONLY" else True) &
-        (dataset["packets_transferred"].between(np.percentile(dataset["packets_transferred"], filters.data_transfer_range[0]),
-                                                np.percentile(dataset["packets_transferred"], filters.data_transfer_range[1])
-                                                if filters.data_transfer_opts == "Custom Range" else True)) &
-        (dataset["n_witnessed"].between(np.percentile(dataset["n_witnessed"], filters.n_witnessed_range[0]),
-                                        np.percentile(dataset["n_witnessed"], filters.n_witnessed_range[1])) if filters.n_witnessed_range else True) &
-        (dataset["total_witnessed"].between(np.percentile(dataset["total_witnessed"], filters.total_witnessed_range[0]),
-                                            np.percentile(dataset["total_witnessed"], filters.total_witnessed_range[1])) if filters.total_witnessed_range else True) &
-        (dataset["min_distance"].between(filters.min_distance_min, filters.min_distance_max)) &
-        (dataset["max_distance"].between(filters.max_distance_min, filters.max_distance_max)) &
-        (dataset["avg_tx_reward_scale"] > 0.999 if filters.perfect_reward_scale_only is True else True) &
-        (dataset["avg_tx_reward_scale"].between(filters.avg_tx_reward_scale_range[0], filters.avg_tx_reward_scale_range[1])
-         if filters.perfect_reward_scale_only is False else True) &
-        (dataset["std_tx_reward_scale"].between(filters.std_tx_reward_scale_range[0], filters.std_tx_reward_scale_range[1])
-         if filters.perfect_reward_scale_only is False else True) &
-        (dataset["n_denylisted_tx"] > 0 if filters.witnesses_denylisted_tx else True) &
-        (dataset["same_maker_ratio"] > 0.999 if filters.same_maker_only else True) &
-        (dataset["avg_tx_age_blocks"].between(filters.avg_tx_age_blocks_range[0], filters.avg_tx_age_blocks_range[1]) if filters.avg_tx_age_blocks_range else True) &
-        (dataset["std_tx_first_block"].between(filters.std_tx_age_blocks_range[0], filters.std_tx_age_blocks_range[1]) if filters.std_tx_age_blocks_range else True) &
-        (dataset["nonce"] > 1 if filters.reasserted_hotspots_only else True) &
-        (dataset["gain"].between(filters.gain_range[0], filters.gain_range[1]) if filters.gain_range else True) &
-        (dataset["elevation"].between(np.percentile(dataset["elevation"], filters.elevation_range[0]),
-                                      np.percentile(dataset["elevation"], filters.elevation_range[1])) if filters.elevation_range else True) &
-        (dataset["rx_on_denylist"] == 1 if filters.on_current_denylist else True) &
-        (dataset["rx_on_denylist"] == 0 if filters.previously_denied or filters.never_denied else True) &
-        (dataset["denied_at_some_point"] if filters.on_any_denylist or filters.previously_denied else True) &
-        (dataset["first_block"] < filters.first_block_max if filters.first_block_max else True) &
-        (dataset["first_block"] > filters.first_block_min if filters.first_block_min else True)
-        ]
-    return filtered
+    # mixture model labels (clustering.py); None keeps every cluster
+    clusters: Optional[List[int]]
+
+    # spatial: within radius_km of (lat, lon), within k_ring_size hex steps of a location's hex, or in hexes holding
+    # at least min_hex_density hotspots (see geo.H3Index)
+    radius_center: Optional[Tuple[float, float]]
+    radius_km: Optional[float]
+    k_ring_center: Optional[str]
+    k_ring_size: Optional[int]
+    k_ring_resolution: int = 8
+    min_hex_density: Optional[int]
+    hex_density_resolution: int = 8
+
+
+def _percentile(dataset: pd.DataFrame, column: str, q: float, index: Optional[FilterIndex]) -> float:
+    if index is not None and column in index:
+        return index.percentile(column, q)
+    return np.percentile(dataset[column], q)
+
+
+# share of rows below which a range clause scatters its sorted-index slice instead of comparing the whole column
+INDEX_SLICE_SELECTIVITY = 0.1
+
+
+class RangeClause:
+    # low <(=) column <(=) high. one-sided comparisons use an infinite bound on the other side. selective ranges on an
+    # indexed column are resolved to the row positions of a slice of the sorted index
+    def __init__(self, column: str, low: float = -np.inf, high: float = np.inf, low_inclusive: bool = True, high_inclusive: bool = True):
+        self.column = column
+        self.low, self.high = low, high
+        self.low_inclusive, self.high_inclusive = low_inclusive, high_inclusive
+        self.positions = None
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        if index is None or self.column not in index:
+            return None
+        count = index.count(self.column, self.low, self.high, self.low_inclusive, self.high_inclusive)
+        if count < index.n * INDEX_SLICE_SELECTIVITY:
+            self.positions = index.range_positions(self.column, self.low, self.high, self.low_inclusive, self.high_inclusive)
+        return count
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        if self.positions is not None:
+            scratch[:] = False
+            scratch[self.positions] = True
+            np.logical_and(out, scratch, out=out)
+            return
+        values = dataset[self.column].to_numpy()
+        if self.low != -np.inf:
+            (np.greater_equal if self.low_inclusive else np.greater)(values, self.low, out=scratch)
+            np.logical_and(out, scratch, out=out)
+        if self.high != np.inf:
+            (np.less_equal if self.high_inclusive else np.less)(values, self.high, out=scratch)
+            np.logical_and(out, scratch, out=out)
+
+
+class IsInClause:
+    def __init__(self, column: str, values: List[str]):
+        self.column = column
+        self.values = values
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        return None
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        np.logical_and(out, dataset[self.column].isin(self.values).to_numpy(), out=out)
+
+
+class FlagClause:
+    # boolean column used directly as a mask
+    def __init__(self, column: str):
+        self.column = column
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        return None
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        np.logical_and(out, dataset[self.column].to_numpy(dtype=bool), out=out)
+
+
+class DenylistReleaseClause:
+    # bitwise tests against the per-hotspot denylist_bits_* release bitsets
+    def __init__(self, release_range: Optional[Tuple[int, int]] = None, first_after: Optional[int] = None):
+        self.release_range = release_range
+        self.first_after = first_after
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        return None
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        bits = dataset[bits_columns(dataset)].to_numpy(dtype=np.uint64)
+        if self.release_range is not None:
+            np.logical_and(out, denied_in_releases(bits, *self.release_range), out=out)
+        if self.first_after is not None:
+            np.logical_and(out, first_denied_after(bits, self.first_after), out=out)
+
+
+class PositionsClause:
+    # rows already resolved by an index lookup (e.g. the spatial filters)
+    def __init__(self, positions: np.ndarray):
+        self.positions = positions
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        return len(self.positions)
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        scratch[:] = False
+        scratch[self.positions] = True
+        np.logical_and(out, scratch, out=out)
+
+
+class BitmapClause:
+    # all categorical / flag clauses, already combined in the packed domain
+    def __init__(self, bitmaps: BitmapIndex, bitmap: np.ndarray):
+        self.bitmaps = bitmaps
+        self.bitmap = bitmap
+
+    def count(self, index: Optional[FilterIndex]) -> Optional[int]:
+        return popcount(self.bitmap)
+
+    def apply(self, dataset: pd.DataFrame, out: np.ndarray, scratch: np.ndarray):
+        np.logical_and(out, self.bitmaps.to_mask(self.bitmap), out=out)
+
+
+class FilterPlan:
+    # active clauses only, most selective first. every clause ANDs into one preallocated mask and evaluation stops
+    # as soon as no rows are left
+    def __init__(self, clauses: list, n: int, index: Optional[FilterIndex] = None):
+        estimated = []
+        for clause in clauses:
+            count = clause.count(index)
+            if count == n:
+                # keeps every row, e.g. a 0-100 percentile range or distance bounds wider than the data
+                continue
+            estimated.append((count / n if count is not None and n > 0 else 0.5, clause))
+        self.clauses = [c for _, c in sorted(estimated, key=lambda x: x[0])]
+        self.n = n
+
+    def mask(self, dataset: pd.DataFrame) -> np.ndarray:
+        out = np.ones(self.n, dtype=bool)
+        scratch = np.empty(self.n, dtype=bool)
+        for clause in self.clauses:
+            clause.apply(dataset, out, scratch)
+            if not out.any():
+                break
+        return out
+
+    def execute(self, dataset: pd.DataFrame) -> pd.DataFrame:
+        return dataset[self.mask(dataset)]
+
+
+def spatial_clauses(filters: Filters, dataset: pd.DataFrame, spatial: Optional[H3Index] = None) -> list:
+    clauses = []
+    if filters.radius_center is None and filters.k_ring_center is None and filters.min_hex_density is None:
+        return clauses
+    spatial = spatial if spatial is not None else H3Index(dataset)
+
+    if filters.radius_center is not None and filters.radius_km is not None:
+        clauses.append(PositionsClause(spatial.radius(filters.radius_center[0], filters.radius_center[1], filters.radius_km)))
+    if filters.k_ring_center is not None and filters.k_ring_size is not None:
+        clauses.append(PositionsClause(spatial.k_ring(filters.k_ring_center, filters.k_ring_size, filters.k_ring_resolution)))
+    if filters.min_hex_density is not None:
+        clauses.append(PositionsClause(spatial.dense_rows(filters.min_hex_density, filters.hex_density_resolution)))
+    return clauses
+
+
+def compile_filters(filters: Filters, dataset: pd.DataFrame, index: Optional[FilterIndex] = None,
+                    bitmaps: Optional[BitmapIndex] = None, spatial: Optional[H3Index] = None) -> FilterPlan:
+    clauses = []
+    bitmap_categories, bitmap_flags = {}, []
+
+    def category(column, values):
+        if bitmaps is not None and bitmaps.has_column(column):
+            bitmap_categories[column] = values
+        else:
+            clauses.append(IsInClause(column, values))
+
+    def flag(name, clause):
+        if bitmaps is not None and bitmaps.has_flag(name):
+            bitmap_flags.append(name)
+        else:
+            clauses.append(clause)
+
+    def percentile_range(column, percentile_range):
+        return RangeClause(column, _percentile(dataset, column, percentile_range[0], index),
+                           _percentile(dataset, column, percentile_range[1], index))
+
+    if "All" not in filters.makers:
+        category("name_maker", filters.makers)
+    if "All" not in filters.countries:
+        category("long_country", filters.countries)
+    if filters.clusters is not None:
+        category("cluster", filters.clusters)
+
+    if filters.data_transfer_opts == "Data Transferring Hotspots ONLY":
+        flag("transferred_data", RangeClause("packets_transferred", low=0, low_inclusive=False))
+    if filters.data_transfer_opts == "NO Data Transferring Hotspots ONLY":
+        flag("no_data_transfer", RangeClause("packets_transferred", 0, 0))
+    if filters.data_transfer_opts == "Custom Range":
+        clauses.append(percentile_range("packets_transferred", filters.data_transfer_range))
+    else:
+        # outside of "Custom Range" the upper bound has always been True (== 1)
+        clauses.append(RangeClause("packets_transferred", _percentile(dataset, "packets_transferred", filters.data_transfer_range[0], index), 1))
+
+    if filters.n_witnessed_range:
+        clauses.append(percentile_range("n_witnessed", filters.n_witnessed_range))
+    if filters.total_witnessed_range:
+        clauses.append(percentile_range("total_witnessed", filters.total_witnessed_range))
+
+    clauses.append(RangeClause("min_distance", filters.min_distance_min, filters.min_distance_max))
+    clauses.append(RangeClause("max_distance", filters.max_distance_min, filters.max_distance_max))
+
+    if filters.perfect_reward_scale_only is True:
+        flag("perfect_reward_scale", RangeClause("avg_tx_reward_scale", low=0.999, low_inclusive=False))
+    if filters.perfect_reward_scale_only is False:
+        clauses.append(RangeClause("avg_tx_reward_scale", filters.avg_tx_reward_scale_range[0], filters.avg_tx_reward_scale_range[1]))
+        clauses.append(RangeClause("std_tx_reward_scale", filters.std_tx_reward_scale_range[0], filters.std_tx_reward_scale_range[1]))
+
+    if filters.witnesses_denylisted_tx:
+        flag("witnessed_denylisted_tx", RangeClause("n_denylisted_tx", low=0, low_inclusive=False))
+    if filters.same_maker_only:
+        flag("same_maker_only", RangeClause("same_maker_ratio", low=0.999, low_inclusive=False))
+    if filters.avg_tx_age_blocks_range:
+        clauses.append(RangeClause("avg_tx_age_blocks", filters.avg_tx_age_blocks_range[0], filters.avg_tx_age_blocks_range[1]))
+    if filters.std_tx_age_blocks_range:
+        clauses.append(RangeClause("std_tx_first_block", filters.std_tx_age_blocks_range[0], filters.std_tx_age_blocks_range[1]))
+    if filters.reasserted_hotspots_only:
+        flag("reasserted", RangeClause("nonce", low=1, low_inclusive=False))
+    if filters.gain_range:
+        clauses.append(RangeClause("gain", filters.gain_range[0], filters.gain_range[1]))
+    if filters.elevation_range:
+        clauses.append(percentile_range("elevation", filters.elevation_range))
+
+    if filters.on_current_denylist:
+        flag("on_current_denylist", RangeClause("rx_on_denylist", 1, 1))
+    if filters.previously_denied or filters.never_denied:
+        flag("not_on_current_denylist", RangeClause("rx_on_denylist", 0, 0))
+    if filters.on_any_denylist or filters.previously_denied:
+        flag("denied_at_some_point", FlagClause("denied_at_some_point"))
+
+    if filters.denied_release_range is not None or filters.first_denied_after is not None:
+        clauses.append(DenylistReleaseClause(filters.denied_release_range, filters.first_denied_after))
+
+    if filters.first_block_max:
+        clauses.append(RangeClause("first_block", high=filters.first_block_max, high_inclusive=False))
+    if filters.first_block_min:
+        clauses.append(RangeClause("first_block", low=filters.first_block_min, low_inclusive=False))
+
+    clauses += spatial_clauses(filters, dataset, spatial)
+
+    if bitmap_categories or bitmap_flags:
+        clauses.append(BitmapClause(bitmaps, bitmaps.combine(bitmap_categories, bitmap_flags)))
+
+    return FilterPlan(clauses, len(dataset), index)
+
+
+def filter_dataset(dataset: pd.DataFrame, filters: Filters, index: Optional[FilterIndex] = None,
+                   bitmaps: Optional[BitmapIndex] = None, spatial: Optional[H3Index] = None) -> pd.DataFrame:
+    return compile_filters(filters, dataset, index, bitmaps, spatial).execute(dataset)
+
+
+def canonical_filters_key(filters: Filters, dataset_version: str) -> str:
+    # order of the multiselects doesn't change the result, and "All" makes the rest of the selection irrelevant
+    options = filters.dict()
+    for key in ("makers", "countries"):
+        if options[key] is not None:
+            options[key] = ["All"] if "All" in options[key] else sorted(options[key])
+    if options["clusters"] is not None:
+        options["clusters"] = sorted(options["clusters"])
+    payload = json.dumps({"dataset": dataset_version, "filters": options}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class FilterResultCache:
+    # LRU of row positions (not DataFrame copies) per canonicalized Filters + dataset version
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 2 ** 20):
+        self.lru = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    @property
+    def hits(self) -> int:
+        return self.lru.hits
+
+    @property
+    def misses(self) -> int:
+        return self.lru.misses
+
+    def positions(self, dataset: pd.DataFrame, filters: Filters, dataset_version: str, index: Optional[FilterIndex] = None,
+                  bitmaps: Optional[BitmapIndex] = None, spatial: Optional[H3Index] = None) -> np.ndarray:
+        key = canonical_filters_key(filters, dataset_version)
+        positions = self.lru.get(key)
+        if positions is None:
+            mask = compile_filters(filters, dataset, index, bitmaps, spatial).mask(dataset)
+            positions = np.flatnonzero(mask).astype(np.int32)
+            self.lru.put(key, positions)
+        return positions
+
+    def filter(self, dataset: pd.DataFrame, filters: Filters, dataset_version: str, index: Optional[FilterIndex] = None,
+               bitmaps: Optional[BitmapIndex] = None, spatial: Optional[H3Index] = None) -> pd.DataFrame:
+        return dataset.iloc[self.positions(dataset, filters, dataset_version, index, bitmaps, spatial)]
@@ -0,0 +1,144 @@
+import pandas as pd
+import numpy as np
+import h3
+from functools import lru_cache
+from typing import Tuple
+
+
+@lru_cache(maxsize=2 ** 20)
+def _h3_to_geo(location: str) -> Tuple[float, float]:
+    return h3.h3_to_geo(location)
+
+
+def h3_to_lat_lon(locations: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    # many hotspots share a hex, so only the distinct cells are converted (and memoized across calls).
+    # missing locations come back as nan
+    codes, cells = pd.factorize(locations)
+    coordinates = np.array([_h3_to_geo(c) for c in cells], dtype=float).reshape(-1, 2)
+    lat, lon = np.full(len(codes), np.nan), np.full(len(codes), np.nan)
+    valid = codes >= 0
+    lat[valid], lon[valid] = coordinates[codes[valid], 0], coordinates[codes[valid], 1]
+    return lat, lon
+
+
+def add_lat_lon(df: pd.DataFrame, location_column: str = "location") -> pd.DataFrame:
+    lat, lon = h3_to_lat_lon(df[location_column])
+    return df.assign(lat=lat, lon=lon)
+
+
+@lru_cache(maxsize=2 ** 20)
+def _h3_to_parent(location: str, resolution: int) -> str:
+    return h3.h3_to_parent(location, min(resolution, h3.h3_get_resolution(location)))
+
+
+def resolution_for_extent(lat: np.ndarray, lon: np.ndarray) -> Tuple[int, float]:
+    # (h3 resolution, mapbox zoom) so the whole extent shows a few thousand hexes at most
+    span = max(np.nanmax(lat) - np.nanmin(lat), np.nanmax(lon) - np.nanmin(lon), 1e-3) if len(lat) else 360
+    zoom = float(np.clip(np.log2(360 / span), 1, 12))
+    resolution = int(np.clip(round(zoom * 0.9), 2, 8))
+    return resolution, zoom
+
+
+def hex_bin_counts(df: pd.DataFrame, resolution: int, location_column: str = "location", flag_column: str = None,
+                   category_column: str = None) -> pd.DataFrame:
+    # hotspots per parent hex at `resolution`, plus the share of rows with `flag_column` set and the most common value
+    # of `category_column` when given
+    codes, cells = pd.factorize(df[location_column])
+    parents = np.array([_h3_to_parent(c, resolution) for c in cells], dtype=object)
+    valid = codes >= 0
+    binned = pd.DataFrame({"hex": parents[codes[valid]]})
+    if flag_column is not None:
+        binned["flag"] = df[flag_column].to_numpy()[valid].astype(float)
+    if category_column is not None:
+        binned["category"] = df[category_column].to_numpy()[valid]
+
+    grouped = binned.groupby("hex")
+    bins = grouped.size().rename("count").to_frame()
+    if flag_column is not None:
+        bins[f"share_{flag_column}"] = grouped["flag"].mean()
+    if category_column is not None:
+        per_category = binned.groupby(["hex", "category"], observed=True).size()
+        bins[f"top_{category_column}"] = per_category.sort_values(ascending=False, kind="stable").reset_index(). \
+            drop_duplicates("hex").set_index("hex")["category"]
+    bins = bins.reset_index()
+    lat, lon = h3_to_lat_lon(bins["hex"])
+    return bins.assign(lat=lat, lon=lon)
+
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# resolutions the neighborhood index keeps row lists for (average hex edge ~22.6 km, ~3.2 km and ~0.46 km)
+INDEX_RESOLUTIONS = [4, 6, 8]
+
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def parent_cells(locations: pd.Series, resolution: int) -> np.ndarray:
+    # parent hex of every location at `resolution` (None where the location is missing)
+    codes, cells = pd.factorize(locations)
+    parents = np.array([_h3_to_parent(c, resolution) for c in cells] + [None], dtype=object)
+    return parents[codes]
+
+
+class H3Index:
+    # row positions grouped by parent hex at each of INDEX_RESOLUTIONS, built once per loaded dataset. k-ring and
+    # radius queries look up the candidate hexes' rows instead of computing distances to every hotspot; radius
+    # candidates are then refined by exact haversine distance
+
+    def __init__(self, dataset: pd.DataFrame, resolutions=INDEX_RESOLUTIONS, location_column: str = "location"):
+        self.n = len(dataset)
+        self.resolutions = sorted(resolutions)
+        if "lat" in dataset.columns and "lon" in dataset.columns:
+            self.lat, self.lon = dataset["lat"].to_numpy(dtype=float), dataset["lon"].to_numpy(dtype=float)
+        else:
+            self.lat, self.lon = h3_to_lat_lon(dataset[location_column])
+
+        # per resolution: hex -> slot, rows ordered by slot, slot offsets into that order, and each row's slot
+        self.slots, self.order, self.offsets, self.row_slots = {}, {}, {}, {}
+        for resolution in self.resolutions:
+            codes, hexes = pd.factorize(parent_cells(dataset[location_column], resolution))
+            valid = codes >= 0
+            self.slots[resolution] = {h: i for i, h in enumerate(hexes)}
+            self.order[resolution] = np.flatnonzero(valid)[np.argsort(codes[valid], kind="stable")].astype(np.int32)
+            self.offsets[resolution] = np.concatenate([[0], np.cumsum(np.bincount(codes[valid], minlength=len(hexes)))])
+            self.row_slots[resolution] = codes
+
+    def rows_in_cells(self, resolution: int, cells) -> np.ndarray:
+        order, offsets, slots = self.order[resolution], self.offsets[resolution], self.slots[resolution]
+        found = [slots[c] for c in cells if c in slots]
+        if not found:
+            return np.array([], dtype=np.int32)
+        return np.concatenate([order[offsets[s]:offsets[s + 1]] for s in found])
+
+    def k_ring(self, location: str, k: int, resolution: int = 8) -> np.ndarray:
+        # rows whose hex at `resolution` is within k grid steps of the hex containing `location`
+        return self.rows_in_cells(resolution, h3.k_ring(_h3_to_parent(location, resolution), k))
+
+    def radius(self, lat: float, lon: float, km: float, max_rings: int = 30) -> np.ndarray:
+        # rows within `km` of (lat, lon). the candidate rings come from the finest indexed resolution that covers the
+        # radius in at most max_rings steps; half the average edge length allows for h3's cell size distortion
+        for resolution in reversed(self.resolutions):
+            edge = h3.edge_length(resolution, "km") / 2
+            k = int(np.ceil((km + 2 * edge) / (1.5 * edge)))
+            if k <= max_rings or resolution == self.resolutions[0]:
+                break
+        candidates = self.rows_in_cells(resolution, h3.k_ring(h3.geo_to_h3(lat, lon, resolution), k))
+        return np.sort(candidates[haversine_km(lat, lon, self.lat[candidates], self.lon[candidates]) <= km])
+
+    def density(self, resolution: int = 8) -> pd.DataFrame:
+        # hotspots per hex at `resolution`, with hex centroids
+        hexes = pd.Series(list(self.slots[resolution].keys()), dtype=object)
+        bins = pd.DataFrame({"hex": hexes, "count": np.diff(self.offsets[resolution])})
+        lat, lon = h3_to_lat_lon(bins["hex"])
+        return bins.assign(lat=lat, lon=lon)
+
+    def dense_rows(self, min_count: int, resolution: int = 8) -> np.ndarray:
+        # rows in hexes holding at least min_count hotspots
+        codes = self.row_slots[resolution]
+        counts = np.append(np.diff(self.offsets[resolution]), 0)
+        return np.flatnonzero(counts[codes] >= min_count).astype(np.int32)
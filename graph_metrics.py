@@ -1,62 +1,113 @@
-import networkx as nx
 import pandas as pd
 from sqlalchemy.engine import create_engine
+import argparse
 import os
 from dotenv import load_dotenv
+from witness_graph import *
+from queries import challenge_watermark_sql, ego_graph_edges_sql
+from graph_metrics_parallel import parallel_graph_metrics, completed_addresses, output_addresses
 
 load_dotenv()
 
 
-engine = create_engine(os.getenv("POSTGRES_CONNECTION_STRING"))
-
 addresses_sql = """
-select distinct(witness_address) from challenge_receipts_parsed limit 2000;
+select distinct(witness_address) from challenge_receipts_parsed limit %(limit)s;
 """
 
-addresses = [a[0] for a in engine.execute(addresses_sql).all()]
-
-results = []
-for i, address in enumerate(addresses):
-    edges_sql = f"""with a as
-    
-    (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address
-     from challenge_receipts_parsed
-     where witness_address = '{address}'),
-     
-    b as
-     (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address from 
-     challenge_receipts_parsed where witness_address in (select transmitter_address from a)
-    )
-     
-    select transmitter_address, witness_address from a
-    union all 
-    select transmitter_address, witness_address from b;"""
-
-    edges = engine.execute(edges_sql).all()
-
-    G = nx.Graph(edges)
-
-    # cliques
-    cliques = nx.cliques_containing_node(G, nodes=[address])[address]
-    clique_sizes = [len(c) for c in cliques]
-    # largest_cliques = [c for c in cliques if len(c) == max(clique_sizes)]
-    if clique_sizes:
-        largest_clique_size = max(clique_sizes)
-
-        # clustering coefficient
-        clustering_coeff = nx.clustering(G, nodes=[address])[address]
-
-        # degree
-        in_degree = G.degree[address]
-
-        # link prediction
-        # non_edges = [(ROOT_NODE_ADDRESS, n) for n in nx.non_neighbors(G, ROOT_NODE_ADDRESS)]
-        # jc = [j for j in nx.jaccard_coefficient(G, non_edges)]
-
-        results.append({"address": address, "largest_clique": largest_clique_size, "clustering_coefficient": clustering_coeff, "in_degree": in_degree})
-
-    if i % 10 == 0:
-        print(f"{i} / {len(addresses)} graphs complete.")
-
-df = pd.DataFrame(results)
-df.to_csv("static/graph_metrics_sample.csv")
\ No newline at end of file
+
+def per_address_metrics(engine, addresses, clique_time_budget=None):
+    # original mode: one 2-hop query per address
+    results = []
+    for i, address in enumerate(addresses):
+        edges = engine.execute(ego_graph_edges_sql, {"address": address}).all()
+
+        graph = WitnessGraph.from_edges(pd.DataFrame(edges, columns=["transmitter_address", "witness_address"]))
+
+        metrics = calculate_graph_metrics(graph, address, clique_time_budget)
+        if metrics:
+            results.append(metrics)
+
+        if i % 10 == 0:
+            print(f"{i} / {len(addresses)} graphs complete.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute 2-hop witness graph metrics for the population distribution.")
+    parser.add_argument("--batch", action="store_true", help="read the edge list once and compute every graph in memory")
+    parser.add_argument("--limit", type=int, default=2000, help="number of witnesses to sample (0 = whole network, batch mode only)")
+    parser.add_argument("--partitions", type=int, default=1, help="number of partitions to read the edge list in")
+    parser.add_argument("--clique-time-budget", type=float, default=None,
+                        help="seconds per hotspot for the clique search; slower ones record a lower bound")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="process pool size for batch mode (0 = serial). output is streamed and resumable")
+    parser.add_argument("--chunk-size", type=int, default=500, help="hotspots per task in parallel mode")
+    parser.add_argument("--graph-dir", default="static/witness_graph",
+                        help="where the edge list is saved as memory-mapped arrays for the workers (reused on resume)")
+    parser.add_argument("--update", action="store_true",
+                        help="fold edges newer than the saved graph's block watermark into --graph-dir and --output, "
+                             "recomputing only affected hotspots")
+    parser.add_argument("--include-new", action="store_true",
+                        help="with --update, also add affected hotspots missing from --output (for whole-network outputs; "
+                             "a sampled output would stop being a random sample)")
+    parser.add_argument("--output", default=None,
+                        help="defaults to static/graph_metrics_sample.csv, or static/graph_metrics_parallel.csv with --workers")
+    args = parser.parse_args()
+    # the parallel driver writes its own csv format, so it doesn't default to the checked-in sample
+    parallel = args.batch and args.workers > 0
+    if args.output is None:
+        args.output = "static/graph_metrics_parallel.csv" if parallel else "static/graph_metrics_sample.csv"
+
+    engine = create_engine(os.getenv("POSTGRES_CONNECTION_STRING"))
+
+    if args.update:
+        graph = WitnessGraph.load(args.graph_dir, mmap=False)
+        low = load_graph_watermark(args.graph_dir)
+        high = engine.execute(challenge_watermark_sql).one()[0]
+        metrics = pd.read_csv(args.output).drop(columns="Unnamed: 0", errors="ignore")
+
+        graph, metrics = update_graph_metrics(graph, metrics, load_new_witness_edges(engine, low, high), args.clique_time_budget,
+                                              args.include_new)
+        # metrics before the graph: if this is interrupted, the rerun still starts from the old graph and watermark and
+        # recomputes the same affected hotspots
+        metrics.to_csv(f"{args.output}.tmp", index=False)
+        os.replace(f"{args.output}.tmp", args.output)
+        commit_graph(graph, args.graph_dir, high)
+
+    elif parallel:
+        # an output the parallel driver can't resume fails here, before the edge list is read
+        if completed_addresses(args.output) and output_addresses(args.output) is None:
+            raise ValueError(f"{args.output} has no saved address list to resume; pass a different --output.")
+        # resuming reuses the saved graph and address list so every chunk is computed against the same edge list and
+        # sample. a fresh output always gets a fresh graph, since the saved one may be from an older edge set
+        resuming = os.path.exists(args.output) and output_addresses(args.output) is not None
+        if resuming and os.path.exists(os.path.join(args.graph_dir, "addresses.txt")):
+            graph = WitnessGraph.load(args.graph_dir)
+        else:
+            watermark = engine.execute(challenge_watermark_sql).one()[0]
+            commit_graph(WitnessGraph.from_edges(load_witness_edges(engine, args.partitions)), args.graph_dir, watermark)
+            graph = WitnessGraph.load(args.graph_dir)
+        if resuming:
+            addresses = output_addresses(args.output)
+        else:
+            addresses = list(graph.addresses[graph.degree() > 0]) if args.limit == 0 else \
+                [a[0] for a in engine.execute(addresses_sql, {"limit": args.limit}).all()]
+        # results are streamed to the output file by the workers
+        parallel_graph_metrics(graph, args.graph_dir, addresses, args.output, args.workers, args.chunk_size, args.clique_time_budget)
+
+    else:
+        if args.batch:
+            # the saved graph + watermark is what --update starts from
+            watermark = engine.execute(challenge_watermark_sql).one()[0]
+            edges = load_witness_edges(engine, args.partitions)
+            graph = WitnessGraph.from_edges(edges)
+            commit_graph(graph, args.graph_dir, watermark)
+            addresses = list(graph.addresses[graph.degree() > 0]) if args.limit == 0 else \
+                [a[0] for a in engine.execute(addresses_sql, {"limit": args.limit}).all()]
+            results = batch_graph_metrics(graph, addresses, args.clique_time_budget)
+        else:
+            addresses = [a[0] for a in engine.execute(addresses_sql, {"limit": args.limit}).all()]
+            results = per_address_metrics(engine, addresses, args.clique_time_budget)
+
+        df = pd.DataFrame(results)
+        df.to_csv(args.output)
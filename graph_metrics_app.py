@@ -4,13 +4,16 @@ import os
 import pandas as pd
 from dotenv import load_dotenv
 import plotly.express as px
-from sqlalchemy.engine import create_engine, Engine
+from sqlalchemy.engine import create_engine
 import networkx as nx
-import h3
+from geo import add_lat_lon
 import numpy as np
+from indexes import FilterIndex
+from ego_graphs import EgoGraphService
 
 
 GRAPH_METRICS_PATH = "static/graph_metrics_sample.csv"
+CLIQUE_TIME_BUDGET = 10 # seconds
 
 load_dotenv()
 token = open(".mapbox_token").read() if ".mapbox_token" in os.listdir() else os.getenv("MAPBOX_TOKEN")
@@ -23,6 +26,18 @@ def load_graph_metrics_distribution(_path):
     return df
 
 
+@st.experimental_memo
+def load_graph_metrics_index(graph_metrics):
+    # sorted metric columns, so each percentile shown is a binary search instead of a scan of the population
+    return FilterIndex(graph_metrics, ["largest_clique", "clustering_coefficient", "in_degree"])
+
+
+@st.experimental_singleton
+def get_ego_graph_service(_engine):
+    # shared across sessions: recently viewed hotspots and their prefetched neighbors are served from memory
+    return EgoGraphService(_engine, clique_time_budget=CLIQUE_TIME_BUDGET)
+
+
 @st.experimental_memo
 def load_makers(_path):
     df = pd.read_csv(_path, index_col="address")
@@ -32,16 +47,15 @@ def load_makers(_path):
 @st.experimental_memo
 def load_gateway_inventory(_engine):
     gateway_inventory = pd.read_sql("select address, name, reward_scale, location, owner, payer, first_block from gateway_inventory;", con=_engine, index_col="address")
-    gateway_inventory["coordinates"] = gateway_inventory["location"].apply(h3.h3_to_geo)
-    gateway_inventory["lat"] = gateway_inventory["coordinates"].apply(lambda x: x[0])
-    gateway_inventory["lon"] = gateway_inventory["coordinates"].apply(lambda x: x[1])
-    return gateway_inventory
+    return add_lat_lon(gateway_inventory)
 
 
 engine = create_engine(os.getenv("POSTGRES_CONNECTION_STRING"))
 graph_metrics = load_graph_metrics_distribution(GRAPH_METRICS_PATH)
+graph_metrics_index = load_graph_metrics_index(graph_metrics)
 gateway_inventory = load_gateway_inventory(engine)
 makers = load_makers("static/makers.csv")
+ego_graph_service = get_ego_graph_service(engine)
 
 st.title("Hotspot Graph Theory")
 
@@ -55,45 +69,11 @@ st.markdown("""This tool can be used to characterize the connectivity of a hotsp
  * **Same Maker/Owner Ratio**: The ratio of hotspots in the graph that are of the same maker/owner as the root node.""")
 
 address = st.text_input("Hotspot Address")
+prefetch_neighbors = st.checkbox("Prefetch graphs of this hotspot's witnesses in the background", value=True)
 
 
-def calculate_graph_metrics(address: str, engine: Engine):
-    edges_sql = f"""with a as
-    
-        (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address
-         from challenge_receipts_parsed
-         where witness_address = '{address}'),
-    
-        b as
-         (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address from 
-         challenge_receipts_parsed where witness_address in (select transmitter_address from a)
-        )
-    
-        select transmitter_address, witness_address from a
-        union all 
-        select transmitter_address, witness_address from b;"""
-
-    edges = engine.execute(edges_sql).all()
-
-    G = nx.Graph(edges)
-
-    # cliques
-    cliques = nx.cliques_containing_node(G, nodes=[address])[address]
-    clique_sizes = [len(c) for c in cliques]
-    largest_clique = [c for c in cliques if len(c) == max(clique_sizes)][0]
-    # largest_clique_size = max(clique_sizes)
-
-    # clustering coefficient
-    clustering_coeff = nx.clustering(G, nodes=[address])[address]
-
-    # degree
-    in_degree = G.degree[address]
-
-    return G, largest_clique, clustering_coeff, in_degree
-
-
-def delta_relative_to_pop(graph_metrics, key, value):
-    return f"{np.round(len(graph_metrics[graph_metrics[key] <= value]) / len(graph_metrics) * 100, 0)}th Percentile"
+def delta_relative_to_pop(graph_metrics_index: FilterIndex, key, value):
+    return f"{np.round(graph_metrics_index.percentile_rank(key, value), 0)}th Percentile"
 
 def blocks_to_est_days(blocks: int):
     return f"Approx. {np.round(blocks / 1440, 1)} day(s)"
@@ -101,7 +81,7 @@ def blocks_to_est_days(blocks: int):
 
 if st.button("Submit"):
     try:
-        G, clique, clustering_coeff, in_degree = calculate_graph_metrics(address, engine)
+        G, clique, clique_exact, clustering_coeff, in_degree = ego_graph_service.get(address, prefetch=prefetch_neighbors)
 
         nodes = pd.DataFrame({"address": n, "order": nx.dijkstra_path_length(G, address, n), "in_clique": True if n in clique else False} for n in G.nodes())
         nodes = nodes.merge(gateway_inventory, left_on="address", right_on=gateway_inventory.index)
@@ -133,8 +113,10 @@ if st.button("Submit"):
         st.subheader("Graph Metrics")
         cols1 = st.columns(3)
         cols1[0].metric("In Degree", in_degree)
-        cols1[1].metric("Largest Clique Size", len(clique), delta=delta_relative_to_pop(graph_metrics, "largest_clique", len(clique)))
-        cols1[2].metric("Clustering Coefficient", np.round(clustering_coeff, 2), delta=delta_relative_to_pop(graph_metrics, "clustering_coefficient", clustering_coeff))
+        cols1[1].metric("Largest Clique Size", len(clique), delta=delta_relative_to_pop(graph_metrics_index, "largest_clique", len(clique)))
+        cols1[2].metric("Clustering Coefficient", np.round(clustering_coeff, 2), delta=delta_relative_to_pop(graph_metrics_index, "clustering_coefficient", clustering_coeff))
+        if not clique_exact:
+            st.caption(f"Clique search stopped after {CLIQUE_TIME_BUDGET}s; the clique size shown is a lower bound.")
 
         pos = {p: (nodes["lon"][p], nodes["lat"][p]) for p in nodes.index}
         fig, ax = plt.subplots()
@@ -161,7 +143,7 @@ if st.button("Submit"):
         cols4[1].metric("2 Degrees", range_first_blocks_overall, delta=blocks_to_est_days(range_first_blocks_overall))
         cols4[2].metric("In Largest Clique", range_first_blocks_clique, delta=blocks_to_est_days(range_first_blocks_clique))
 
-        st.dataframe(nodes.drop(["coordinates", "location", "lat", "lon", "payer", "marker_size"], axis=1).style.hide(axis="index").background_gradient(cmap="Blues"))
+        st.dataframe(nodes.drop(["location", "lat", "lon", "payer", "marker_size"], axis=1).style.hide(axis="index").background_gradient(cmap="Blues"))
         st.download_button(
             "Export CSV",
             nodes.to_csv().encode("utf-8"),
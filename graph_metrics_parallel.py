@@ -0,0 +1,115 @@
+import pandas as pd
+import numpy as np
+import multiprocessing as mp
+import os
+import json
+from typing import List, Optional
+from witness_graph import WitnessGraph, load_graph_watermark
+from cliques import largest_clique_containing
+
+
+OUTPUT_COLUMNS = ["address", "largest_clique", "largest_clique_exact", "clustering_coefficient", "in_degree"]
+
+# set once per worker process by _init_worker
+_graph = None
+_clique_time_budget = None
+
+
+def _init_worker(graph_dir: str, clique_time_budget: float):
+    # every worker memory-maps the same .npy files, so the adjacency is shared through the page cache
+    global _graph, _clique_time_budget
+    _graph = WitnessGraph.load(graph_dir, mmap=True, with_addresses=False)
+    _clique_time_budget = clique_time_budget
+
+
+def _metrics_for_chunk(nodes: np.ndarray) -> List[tuple]:
+    degree = _graph.degree()[nodes]
+    clustering = _graph.clustering(nodes)
+    rows = []
+    for node, d, c in zip(nodes, degree, clustering):
+        if d == 0:
+            continue
+        clique, exact = largest_clique_containing(_graph, node, _clique_time_budget)
+        rows.append((int(node), len(clique), exact, c, int(d)))
+    return rows
+
+
+def drop_partial_line(output: str):
+    # an interrupted append can leave half a row at the end of the file; cut back to the last complete line (rows are
+    # far shorter than the tail that's read)
+    with open(output, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+        if tail and not tail.endswith(b"\n"):
+            f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+
+
+def output_graph_watermark(output: str) -> Optional[int]:
+    # block watermark of the graph `output` was started against
+    path = f"{output}.watermark.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["watermark"]
+
+
+def save_output_graph_watermark(output: str, block: int):
+    with open(f"{output}.watermark.json", "w") as f:
+        json.dump({"watermark": int(block)}, f)
+
+
+def output_addresses(output: str) -> Optional[List[str]]:
+    # the hotspots `output` was started for, so a resumed run targets the same sample
+    path = f"{output}.addresses.txt"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().split("\n")
+
+
+def save_output_addresses(output: str, addresses: List[str]):
+    with open(f"{output}.addresses.txt", "w") as f:
+        f.write("\n".join(addresses))
+
+
+def completed_addresses(output: str) -> set:
+    if not os.path.exists(output):
+        return set()
+    drop_partial_line(output)
+    if os.path.getsize(output) == 0:
+        return set()
+    if list(pd.read_csv(output, nrows=0).columns) != OUTPUT_COLUMNS:
+        raise ValueError(f"{output} exists but wasn't written by the parallel driver; pass a different --output to resume into.")
+    return set(pd.read_csv(output, usecols=["address"], dtype={"address": str})["address"])
+
+
+def parallel_graph_metrics(graph: WitnessGraph, graph_dir: str, addresses: List[str], output: str, workers: int = None,
+                           chunk_size: int = 500, clique_time_budget: float = None):
+    # addresses already in `output` are skipped, so an interrupted run picks up where it stopped. finished chunks are
+    # appended to the csv as they come back. a run only resumes against the graph and the address list it was started
+    # with; `addresses` is ignored on resume
+    done = completed_addresses(output)
+    watermark = load_graph_watermark(graph_dir)
+    if done:
+        if output_graph_watermark(output) != watermark:
+            raise ValueError(f"{output} was started against a different graph than {graph_dir}; pass a different --output.")
+        if output_addresses(output) is None:
+            raise ValueError(f"{output} has no saved address list to resume; pass a different --output.")
+        addresses = output_addresses(output)
+    save_output_graph_watermark(output, watermark)
+    save_output_addresses(output, list(addresses))
+    remaining = [a for a in addresses if a in graph and a not in done]
+    nodes = graph.ids(remaining)
+    chunks = [nodes[i:i + chunk_size] for i in range(0, len(nodes), chunk_size)]
+    print(f"{len(done)} hotspots already complete, {len(remaining)} remaining in {len(chunks)} chunks.")
+
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    with mp.Pool(workers, initializer=_init_worker, initargs=(graph_dir, clique_time_budget)) as pool, open(output, "a") as f:
+        for i, rows in enumerate(pool.imap_unordered(_metrics_for_chunk, chunks)):
+            df = pd.DataFrame(rows, columns=["node"] + OUTPUT_COLUMNS[1:])
+            df.insert(0, "address", graph.addresses[df.pop("node").to_numpy()])
+            df.to_csv(f, header=write_header, index=False)
+            f.flush()
+            write_header = False
+            print(f"{i + 1} / {len(chunks)} chunks complete.")
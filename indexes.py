@@ -0,0 +1,133 @@
+import pandas as pd
+import numpy as np
+from typing import List, Union
+
+
+# columns that filters.py selects on by percentile
+PERCENTILE_COLUMNS = ["packets_transferred", "n_witnessed", "total_witnessed", "elevation"]
+
+# every numeric column filters.py compares against. sorted copies give exact clause counts for plan ordering
+RANGE_COLUMNS = PERCENTILE_COLUMNS + ["min_distance", "max_distance", "avg_tx_reward_scale", "std_tx_reward_scale",
+                                      "n_denylisted_tx", "same_maker_ratio", "avg_tx_age_blocks", "std_tx_first_block",
+                                      "nonce", "gain", "first_block", "rx_on_denylist"]
+
+
+class FilterIndex:
+    # sorted copies of the filtered numeric columns, built once per loaded dataset. a percentile is then an O(1)
+    # lookup into the sorted array and a range filter is two binary searches plus a slice of the argsort order.
+
+    def __init__(self, dataset: pd.DataFrame, columns: List[str] = RANGE_COLUMNS):
+        self.n = len(dataset)
+        self.order = {}
+        self.sorted = {}
+        for column in columns:
+            if column not in dataset.columns:
+                continue
+            values = dataset[column].to_numpy(dtype=float)
+            order = np.argsort(values, kind="stable").astype(np.int32)
+            self.order[column] = order
+            self.sorted[column] = values[order]
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.sorted
+
+    def percentile(self, column: str, q: Union[int, float]) -> float:
+        # same result as np.percentile(values, q) with the default linear method, without re-sorting
+        values = self.sorted[column]
+        virtual_index = (len(values) - 1) * np.true_divide(q, 100)
+        previous_index = int(np.floor(virtual_index))
+        next_index = min(previous_index + 1, len(values) - 1)
+        gamma = virtual_index - previous_index
+
+        a, b = values[previous_index], values[next_index]
+        if gamma >= 0.5:
+            return b - (b - a) * (1 - gamma)
+        return a + (b - a) * gamma
+
+    def percentile_rank(self, column: str, value: float) -> float:
+        # share of rows (in %) with column <= value, by binary search
+        return np.searchsorted(self.sorted[column], value, side="right") / self.n * 100
+
+    def _bounds(self, column: str, low: float, high: float, low_inclusive: bool = True, high_inclusive: bool = True):
+        values = self.sorted[column]
+        start = np.searchsorted(values, low, side="left" if low_inclusive else "right")
+        stop = np.searchsorted(values, high, side="right" if high_inclusive else "left")
+        return start, max(start, stop)
+
+    def count(self, column: str, low: float, high: float, low_inclusive: bool = True, high_inclusive: bool = True) -> int:
+        start, stop = self._bounds(column, low, high, low_inclusive, high_inclusive)
+        return stop - start
+
+    def range_positions(self, column: str, low: float, high: float, low_inclusive: bool = True,
+                        high_inclusive: bool = True) -> np.ndarray:
+        # row positions with low <(=) value <(=) high, in sorted-value order
+        start, stop = self._bounds(column, low, high, low_inclusive, high_inclusive)
+        return self.order[column][start:stop]
+
+
+# low-cardinality dimensions and boolean predicates served from packed bitmaps. each flag must match the
+# comparison filters.py would otherwise run on the column
+BITMAP_CATEGORICAL_COLUMNS = ["name_maker", "long_country", "cluster"]
+
+BITMAP_FLAGS = {
+    "transferred_data": ("packets_transferred", lambda x: x > 0),
+    "no_data_transfer": ("packets_transferred", lambda x: x == 0),
+    "perfect_reward_scale": ("avg_tx_reward_scale", lambda x: x > 0.999),
+    "witnessed_denylisted_tx": ("n_denylisted_tx", lambda x: x > 0),
+    "same_maker_only": ("same_maker_ratio", lambda x: x > 0.999),
+    "reasserted": ("nonce", lambda x: x > 1),
+    "on_current_denylist": ("rx_on_denylist", lambda x: x == 1),
+    "not_on_current_denylist": ("rx_on_denylist", lambda x: x == 0),
+    "denied_at_some_point": ("denied_at_some_point", lambda x: x.astype(bool)),
+}
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bitmap: np.ndarray) -> int:
+    return int(_POPCOUNT[bitmap].sum(dtype=np.int64))
+
+
+class BitmapIndex:
+    # one bit-packed (np.packbits, 1 bit per row) bitmap per category value and per flag. multi-select filters OR the
+    # value bitmaps together and all categorical / flag clauses AND into one bitmap, touching n / 8 bytes per operation
+
+    def __init__(self, dataset: pd.DataFrame, categorical_columns: List[str] = BITMAP_CATEGORICAL_COLUMNS,
+                 flags: dict = BITMAP_FLAGS):
+        self.n = len(dataset)
+        self.categories = {}
+        for column in categorical_columns:
+            if column not in dataset.columns:
+                continue
+            codes, uniques = pd.factorize(dataset[column])
+            self.categories[column] = {value: np.packbits(codes == i) for i, value in enumerate(uniques)}
+
+        self.flags = {}
+        for name, (column, predicate) in flags.items():
+            if column in dataset.columns:
+                self.flags[name] = np.packbits(predicate(dataset[column].to_numpy()))
+
+    def has_column(self, column: str) -> bool:
+        return column in self.categories
+
+    def has_flag(self, name: str) -> bool:
+        return name in self.flags
+
+    def any_of(self, column: str, values: List[str]) -> np.ndarray:
+        bitmap = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+        for value in values:
+            if value in self.categories[column]:
+                np.bitwise_or(bitmap, self.categories[column][value], out=bitmap)
+        return bitmap
+
+    def combine(self, categories: dict, flags: List[str]) -> np.ndarray:
+        # AND of (OR of the selected values) per column and every requested flag
+        bitmap = np.packbits(np.ones(self.n, dtype=bool))
+        for column, values in categories.items():
+            np.bitwise_and(bitmap, self.any_of(column, values), out=bitmap)
+        for name in flags:
+            np.bitwise_and(bitmap, self.flags[name], out=bitmap)
+        return bitmap
+
+    def to_mask(self, bitmap: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bitmap, count=self.n).view(bool)
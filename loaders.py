@@ -5,51 +5,123 @@ import os
 from queries import *
 from sqlalchemy.engine import Engine
 from pydantic import BaseModel
-from typing import List
-import requests
-import numpy as np
+from typing import List, Optional
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from receipt_aggregates import refresh_receipt_aggregates
+from dataset_cache import *
+from geo import add_lat_lon
+from denylist import DenylistStore, release_membership
+from views import summaries_available, summary_freshness
+from clustering import label_dataset
 
 
 def load_unique_denied_hotspots():
-    r = requests.get("https://api.github.com/repos/helium/denylist/releases").json()
-    tags = [t["tag_name"] for t in r]
+    # releases are kept in static/denylist; only tags published since the last run are downloaded
+    return DenylistStore.from_env().denied_addresses()
 
-    denylist = pd.DataFrame(columns=["address"])
-    for tag in tags:
-        data = requests.get(f"https://raw.githubusercontent.com/helium/denylist/{tag}/denylist.csv")
 
-        release_list = pd.DataFrame(data.text.split(",\n"), columns=["address"])
-        release_list["address"].replace('', np.nan, inplace=True)
-        release_list = release_list.dropna()
-        denylist = pd.concat([denylist, release_list])
-    return set(denylist["address"])
+def load_denylist_releases() -> dict:
+    # tag -> addresses, oldest release first (the bit order of release_membership)
+    return DenylistStore.from_env().releases()
+
+
+def downcast(chunk: pd.DataFrame) -> pd.DataFrame:
+    # numeric columns to their cache dtype as soon as a chunk arrives (postgres numeric sums come back as Decimal
+    # objects). integer columns with nulls stay float until the final dropna; categories are applied once at the end
+    for column, dtype in DATASET_DTYPES.items():
+        if column not in chunk.columns or dtype in ("category", "bool"):
+            continue
+        if dtype.startswith("int") and chunk[column].isna().any():
+            dtype = "float64"
+        chunk[column] = chunk[column].astype(dtype)
+    return chunk
+
+
+def read_sql_chunked(sql: str, engine: Engine, chunksize: int = 50000, fillna=None) -> pd.DataFrame:
+    # server-side cursor: rows arrive chunksize at a time instead of the driver buffering the whole result set,
+    # and the downcast chunks are concatenated once
+    with engine.connect().execution_options(stream_results=True) as conn:
+        chunks = []
+        for chunk in pd.read_sql(sql, con=conn, chunksize=chunksize):
+            if fillna is not None:
+                chunk = chunk.fillna(fillna)
+            chunks.append(downcast(chunk))
+    if not chunks:
+        # an empty result yields no chunks at all; keep the columns so merges downstream still line up
+        return downcast(pd.read_sql(f"select * from ({sql.strip().rstrip(';')}) q limit 0;", con=engine))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+def peak_rss_mb() -> float:
+    # high-water mark of this process (ru_maxrss is in KB on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(name: str, load):
+    start = time.perf_counter()
+    result = load()
+    print(f"Loaded {name} in {time.perf_counter() - start:.1f}s")
+    return result
+
+
+def load_concurrently(sources: dict) -> dict:
+    # name -> zero-argument loader. independent sources run on their own thread (and pooled connection), so the
+    # wall time is the slowest source rather than the sum
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(sources)) as pool:
+        futures = {name: pool.submit(timed, name, load) for name, load in sources.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    print(f"Loaded {len(sources)} sources in {time.perf_counter() - start:.1f}s")
+    return results
 
 
 @st.experimental_memo(ttl=86400) # refresh daily
-def load_dataset(_engine: Engine) -> pd.DataFrame:
+def load_dataset(_engine: Engine, incremental: bool = False, columns: Optional[List[str]] = None) -> pd.DataFrame:
     today_str = datetime.today().strftime("%Y-%m-%d")
-    result_path = f"static/cache_{today_str}.csv.gz"
+    result_path = cache_path(today_str)
+    legacy_path = cache_path(today_str, "csv.gz")
+
+    # caches written before the parquet format are converted once, then read like any other
+    if os.path.exists(result_path) is False and os.path.exists(legacy_path):
+        migrate_csv_cache(legacy_path, result_path)
 
     # see if cache already exists locally
     if os.path.exists(result_path):
         print("Loading dataset locally...")
-        dataset = pd.read_csv(result_path, index_col=0)
+        dataset = read_dataset_cache(result_path, columns)
+
+        # caches from before coordinates were stored
+        if "location" in dataset.columns and "lat" not in dataset.columns:
+            dataset = add_lat_lon(dataset)
 
     # if not, pull from postgres
     else:
         print("Loading dataset from database...")
-        # detailed_receipts query
-        result = pd.read_sql(detailed_receipt_sql, con=_engine).fillna(0)
-
+        # the precomputed summaries (views.py) when they exist, instead of grouping every receipt on a cold start
+        summarized = summaries_available(_engine, ["receipt_summary", "data_transfer_summary"])
+        if summarized:
+            print(f"Reading summaries, last refreshed:\n{summary_freshness(_engine)['refreshed_at']}")
+        receipts_sql = "select * from receipt_summary;" if summarized else detailed_receipt_sql
+        transfer_sql = "select * from data_transfer_summary;" if summarized else data_transfer_sql
+
+        # detailed_receipts aggregate (incremental mode only folds in receipts past the last stored block watermark),
         # gateway inventory, makers, anytime denylist, and data transfer for additional details
-        gateway_inventory = pd.read_sql("gateway_inventory", con=_engine)
-        makers = pd.read_csv("static/makers.csv")
-        denied_set = load_unique_denied_hotspots()
-        data_transfer = pd.read_sql(data_transfer_sql, con=_engine)
+        sources = load_concurrently({
+            "receipts": (lambda: refresh_receipt_aggregates(_engine).fillna(0)) if incremental else
+                        (lambda: read_sql_chunked(receipts_sql, _engine, fillna=0)),
+            "gateway_inventory": lambda: read_sql_chunked(gateway_inventory_sql, _engine),
+            "makers": lambda: pd.read_csv("static/makers.csv"),
+            "denylist": load_denylist_releases,
+            "data_transfer": lambda: read_sql_chunked(transfer_sql, _engine),
+        })
+        result, gateway_inventory, makers = sources["receipts"], sources["gateway_inventory"], sources["makers"]
+        denylist_releases, data_transfer = sources["denylist"], sources["data_transfer"]
 
         # inner join drops inactive gateways. drop extraneous columns
         dataset = result.merge(gateway_inventory, on="address").merge(makers, left_on="payer", right_on="address", suffixes=("_gateway", "_maker")). \
-            drop(["Unnamed: 0", "last_poc_onion_key_hash", "last_poc_challenge", "mode", "payer", "first_timestamp"], axis=1)
+            drop(["Unnamed: 0", "payer"], axis=1)
 
         print(dataset.columns)
 
@@ -61,18 +133,36 @@ def load_dataset(_engine: Engine) -> pd.DataFrame:
         dataset.loc[dataset["slope_rssi_distance"] > 10, "slope_rssi_distance"] = 10
         dataset.loc[dataset["slope_rssi_distance"] < -10, "slope_rssi_distance"] = -10
 
-        # add denied set
-        dataset["denied_at_some_point"] = dataset["address_gateway"].apply(lambda x: x in denied_set)
+        # which denylist releases each hotspot appeared on, as a bitset; any bit set means denied at some point
+        membership = release_membership(dataset["address_gateway"], denylist_releases)
+        dataset = pd.concat([dataset, membership], axis=1)
+        dataset["denied_at_some_point"] = membership.to_numpy().any(axis=1)
 
-        # save today's cache locally
-        if os.path.isdir("static") is False:
-            os.mkdir("static")
-        dataset.to_csv(result_path, compression="gzip")
+        # coordinates once at load time, so maps don't convert h3 indexes on every submit
+        dataset = add_lat_lon(dataset)
+
+        # cluster labels from the persisted mixture model (clustering_gmm.py), if one has been fit
+        labels = label_dataset(dataset)
+        if labels is not None:
+            dataset["cluster"] = labels
+
+        # save today's cache locally (all columns), then hand back only what the caller asked for
+        dataset = apply_schema(dataset)
+        write_dataset_cache(dataset, result_path)
+        write_denylist_tags(list(denylist_releases), result_path)
+        print(f"Dataset built, peak RSS {peak_rss_mb():.0f} MB")
+        if columns is not None:
+            dataset = dataset[[c for c in columns if c in dataset.columns]]
 
     # return our large table of active hotspots, their details and metrics
     return dataset
 
 
+def load_denylist_tags() -> List[str]:
+    # the bit order of today's cache, not whatever the release store reports now
+    return read_denylist_tags(cache_path(datetime.today().strftime("%Y-%m-%d")))
+
+
 class FormConfig(BaseModel):
     makers: List[str]
     countries: List[str]
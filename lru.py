@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import threading
+import sys
+
+
+class LRUCache:
+    # bounded by entry count and (optionally) by the total size of the stored values. streamlit serves sessions from
+    # several threads, so every access takes the lock
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any, nbytes: Optional[int] = None):
+        nbytes = getattr(value, "nbytes", sys.getsizeof(value)) if nbytes is None else nbytes
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            # evict least recently used, but always keep the entry just added
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                              (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses}
@@ -3,8 +3,14 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-import h3
 import streamlit as st
+from geo import add_lat_lon, resolution_for_extent, hex_bin_counts
+
+
+# above this many filtered rows, app.py's automatic mode ships aggregated plots instead of raw points
+AGGREGATE_THRESHOLD = 5000
+
+SOURCE_COLORS = {"filtered": px.colors.qualitative.Plotly[0], "baseline": px.colors.qualitative.Plotly[1]}
 
 
 def plot_histogram(plot_df, on_key: str):
@@ -12,6 +18,51 @@ def plot_histogram(plot_df, on_key: str):
     return fig
 
 
+def box_stats(values: np.ndarray) -> dict:
+    # precomputed box plot: quartiles and tukey fences clamped to the data, like plotly computes client-side
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return dict(q1=[np.nan], median=[np.nan], q3=[np.nan], lowerfence=[np.nan], upperfence=[np.nan])
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return dict(q1=[q1], median=[median], q3=[q3], lowerfence=[inside.min()], upperfence=[inside.max()])
+
+
+def plot_binned_histogram(series: dict, edges: np.ndarray, on_key: str):
+    # histogram from bin counts computed server-side; `series` maps source name -> (counts per bin, box statistics).
+    # only the counts and five box statistics per source are sent to the browser
+    centers, widths = (edges[:-1] + edges[1:]) / 2, np.diff(edges)
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_heights=[0.2, 0.8], vertical_spacing=0.02)
+    for name, (counts, box) in series.items():
+        color = SOURCE_COLORS.get(name)
+        fig.add_trace(go.Box(y=[name], orientation="h", name=name, legendgroup=name, showlegend=False,
+                             marker_color=color, **box), row=1, col=1)
+        fig.add_trace(go.Bar(x=centers, y=counts / max(counts.sum(), 1), width=widths, name=name, legendgroup=name,
+                             marker_color=color, opacity=0.5), row=2, col=1)
+    fig.update_layout(barmode="overlay", legend_title_text="source")
+    fig.update_xaxes(title_text=on_key, row=2, col=1)
+    fig.update_yaxes(title_text="probability", row=2, col=1)
+    return fig
+
+
+def plot_histogram_aggregated(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame, on_key: str, bins: int = 50):
+    filtered, baseline = filtered_df[on_key].to_numpy(dtype=float), baseline_df[on_key].to_numpy(dtype=float)
+    combined = np.concatenate([filtered, baseline])
+    edges = np.histogram_bin_edges(combined[np.isfinite(combined)], bins=bins)
+    series = {name: (np.histogram(values[np.isfinite(values)], bins=edges)[0], box_stats(values))
+              for name, values in [("filtered", filtered), ("baseline", baseline)]}
+    return plot_binned_histogram(series, edges, on_key)
+
+
+def plot_comparison_histogram(filtered_stats, baseline_stats, on_key: str):
+    # same chart from stats.SelectionStats, whose bins were fixed on the full dataset
+    i = filtered_stats.position[on_key]
+    series = {"filtered": (filtered_stats.counts[i], filtered_stats.box(on_key)),
+              "baseline": (baseline_stats.counts[i], baseline_stats.box(on_key))}
+    return plot_binned_histogram(series, filtered_stats.edges[i], on_key)
+
+
 def plot_witness_distances(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame, color_key: str = "source"):
     fig = go.Figure()
     fig.add_trace(go.Histogram(x=filtered_df["med_distance"],
@@ -211,6 +262,22 @@ def plot_data_transfer(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame):
     return fig
 
 
+def plot_data_transfer_comparison(filtered_stats, baseline_stats):
+    # plot_data_transfer's donuts from stats.SelectionStats
+    labels = ["Transferred Packets", "No Data Transfer"]
+    fig = make_subplots(rows=1, cols=2, specs=[[{'type':'domain'}, {'type':'domain'}]])
+    for col, stats in enumerate([filtered_stats, baseline_stats], start=1):
+        share = stats.share_positive("packets_transferred")
+        fig.add_trace(go.Pie(labels=labels, values=[share, 1 - share]), 1, col)
+    fig.update_traces(hole=.4, hoverinfo="label+percent+name")
+
+    fig.update_layout(
+        # Add annotations in the center of the donut pies.
+        annotations=[dict(text="Filtered", x=0.18, y=0.5, font_size=20, showarrow=False),
+                     dict(text="Baseline", x=0.82, y=0.5, font_size=20, showarrow=False)])
+    return fig
+
+
 def plot_manufacturer_breakdown(filtered_df: pd.DataFrame):
     fig = px.pie(filtered_df, names="name_maker")
     fig.update_layout(
@@ -237,7 +304,7 @@ def plot_denylist_breakdown(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame
 
 
 def plot_ownership_breakdown(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame):
-    hotspots_by_owner_filtered = pd.DataFrame(filtered_df.groupby("owner").size())
+    hotspots_by_owner_filtered = pd.DataFrame(filtered_df.groupby("owner", observed=True).size())
     hotspots_by_owner_filtered["source"] = "filtered"
     baseline_df["source"] = "baseline"
     plot_df = pd.concat([hotspots_by_owner_filtered, baseline_df])
@@ -248,11 +315,9 @@ def plot_ownership_breakdown(filtered_df: pd.DataFrame, baseline_df: pd.DataFram
 
 
 def plot_hotspot_locations(filtered_df: pd.DataFrame, color_key: str = "denied_at_some_point"):
-    # not sure why result_type = "expand" isn't doing this in one step
-
-    filtered_df["coords"] = filtered_df["location"].apply(h3.h3_to_geo)
-    filtered_df["lat"] = filtered_df["coords"].apply(lambda x: x[0])
-    filtered_df["lon"] = filtered_df["coords"].apply(lambda x: x[1])
+    # lat / lon are normally stored at load time; convert on a copy otherwise
+    if "lat" not in filtered_df.columns:
+        filtered_df = add_lat_lon(filtered_df)
 
     fig = px.scatter_mapbox(filtered_df, lat="lat", lon="lon", hover_name="address_gateway", color=color_key)
     fig.update_layout(mapbox_style="dark",
@@ -267,6 +332,31 @@ def plot_hotspot_locations(filtered_df: pd.DataFrame, color_key: str = "denied_a
     return fig
 
 
+def plot_hotspot_hexbins(filtered_df: pd.DataFrame, color_key: str = "denied_at_some_point", resolution: int = None):
+    # hotspots aggregated into h3 hexes at a resolution that fits the result's extent, instead of one marker per row.
+    # hexes are colored by the share of a boolean color_key, or by the most common value of any other column
+    suggested, zoom = resolution_for_extent(filtered_df["lat"].to_numpy(), filtered_df["lon"].to_numpy())
+    resolution = suggested if resolution is None else resolution
+    is_flag = color_key in filtered_df.columns and filtered_df[color_key].dtype == bool
+    is_category = color_key in filtered_df.columns and not is_flag
+    bins = hex_bin_counts(filtered_df, resolution, flag_column=color_key if is_flag else None,
+                          category_column=color_key if is_category else None)
+    color = f"share_{color_key}" if is_flag else f"top_{color_key}" if is_category else "count"
+
+    # one marker per hex centroid, sized by its hotspot count
+    fig = px.scatter_mapbox(bins, lat="lat", lon="lon", size="count", color=color,
+                            hover_name="hex", hover_data=["count"], color_continuous_scale="Viridis", size_max=30)
+    # an empty result has no hexes to center on
+    center = dict(lat=float(np.average(bins["lat"], weights=bins["count"])),
+                  lon=float(np.average(bins["lon"], weights=bins["count"]))) if len(bins) else dict(lat=0., lon=0.)
+    fig.update_layout(mapbox_style="dark",
+                      mapbox_zoom=zoom if len(bins) else 1,
+                      mapbox_center=center,
+                      showlegend=is_category,
+                      margin={'l':0, 'r':0, 'b':0, 't':0})
+    return fig
+
+
 def zscore(mu, std, sample_mean):
     return np.round((sample_mean - mu) / std, 1)
 
@@ -283,4 +373,20 @@ def generate_metrics(filtered_df: pd.DataFrame, baseline_df: pd.DataFrame, featu
     cols[3].metric("Filtered Middle 95%", value=np.round(filtered_std, 1))
     cols[4].metric("Z-Score of Filtered",
                     value=zscore(baseline_mean, baseline_std, filtered_mean))
-    return cols
\ No newline at end of file
+    return cols
+
+def generate_comparison_metrics(filtered_stats, baseline_stats, feature_key: str):
+    # metric tiles from the precomputed stats.SelectionStats instead of re-reducing both frames
+    i = filtered_stats.position[feature_key]
+
+    def middle_95(stats):
+        return stats.quantile(feature_key, 97.5) - stats.quantile(feature_key, 2.5)
+
+    cols = st.columns(5)
+
+    cols[0].metric("Baseline Median", value=np.round(baseline_stats.quantile(feature_key, 50), 1))
+    cols[1].metric("Baseline Middle 95%", value=np.round(middle_95(baseline_stats), 1))
+    cols[2].metric("Filtered Median", value=np.round(filtered_stats.quantile(feature_key, 50), 1))
+    cols[3].metric("Filtered Middle 95%", value=np.round(middle_95(filtered_stats), 1))
+    cols[4].metric("Z-Score of Filtered", value=np.round(filtered_stats.zscores(baseline_stats)[i], 1))
+    return cols
@@ -60,8 +60,214 @@ group by client;
 """
 
 
+# the inventory columns the dataset keeps (plus payer, to join makers). the ones load_dataset always dropped (mode,
+# last_poc_challenge, last_poc_onion_key_hash, first_timestamp) are left in the database
+gateway_inventory_sql = """
+select address, name, owner, location, location_hex, first_block, last_block, nonce, gain, elevation, reward_scale, payer
+from gateway_inventory;
+"""
+
+
 n_blocks_sql = """
 select max(block) - min(block) from challenge_receipts_parsed;
 """
 
 
+
+
+# mergeable per-rx_address partial aggregates over a block range, used by the incremental refresh in
+# receipt_aggregates.py. univariate moments are (count, mean, M2) and regression moments are the centered
+# regr_* sums, so partials from different block ranges can be combined without re-reading old receipts. the
+# denylist columns come from the per-pair counts below.
+receipt_partials_sql = """
+select
+
+rx_address as address,
+count(tx_address)                                   as total_witnessed,
+min(distance_km)                                    as min_distance,
+max(distance_km)                                    as max_distance,
+sum(
+    CASE WHEN
+    tx_payer = rx_payer THEN 1
+    ELSE 0
+    END
+)                                                   as n_same_maker,
+
+count(tx_reward_scale)                              as reward_scale_n,
+coalesce(avg(tx_reward_scale), 0)                   as reward_scale_mean,
+coalesce(var_samp(tx_reward_scale), 0) * greatest(count(tx_reward_scale) - 1, 0) as reward_scale_m2,
+
+count(witness_signal)                               as signal_n,
+coalesce(avg(witness_signal), 0)                    as signal_mean,
+coalesce(var_samp(witness_signal), 0) * greatest(count(witness_signal) - 1, 0) as signal_m2,
+
+count(witness_snr)                                  as snr_n,
+coalesce(avg(witness_snr), 0)                       as snr_mean,
+coalesce(var_samp(witness_snr), 0) * greatest(count(witness_snr) - 1, 0) as snr_m2,
+
+count(tx_first_block)                               as tx_first_block_n,
+coalesce(avg(tx_first_block), 0)                    as tx_first_block_mean,
+coalesce(var_samp(tx_first_block), 0) * greatest(count(tx_first_block) - 1, 0) as tx_first_block_m2,
+
+regr_count(witness_signal, distance_km)             as rssi_distance_n,
+coalesce(regr_avgx(witness_signal, distance_km), 0) as rssi_distance_mx,
+coalesce(regr_avgy(witness_signal, distance_km), 0) as rssi_distance_my,
+coalesce(regr_sxx(witness_signal, distance_km), 0)  as rssi_distance_sxx,
+coalesce(regr_syy(witness_signal, distance_km), 0)  as rssi_distance_syy,
+coalesce(regr_sxy(witness_signal, distance_km), 0)  as rssi_distance_sxy,
+
+regr_count(witness_signal, witness_snr)             as rssi_snr_n,
+coalesce(regr_avgx(witness_signal, witness_snr), 0) as rssi_snr_mx,
+coalesce(regr_avgy(witness_signal, witness_snr), 0) as rssi_snr_my,
+coalesce(regr_sxx(witness_signal, witness_snr), 0)  as rssi_snr_sxx,
+coalesce(regr_syy(witness_signal, witness_snr), 0)  as rssi_snr_syy,
+coalesce(regr_sxy(witness_signal, witness_snr), 0)  as rssi_snr_sxy
+
+from detailed_receipts
+where block > %(low)s and block <= %(high)s
+group by rx_address;
+"""
+
+
+# receipts per (rx, tx) pair, so count(distinct tx_address) stays exact across refreshes, plus the table's own denylist
+# flags as counts: sum(tx_on_denylist) and max(rx_on_denylist) of the full aggregate are sums / "any" over the pairs
+receipt_pairs_sql = """
+select rx_address as address, tx_address, count(*) as n, sum(tx_on_denylist) as n_denylisted_tx,
+sum(rx_on_denylist) as n_rx_on_denylist
+from detailed_receipts
+where block > %(low)s and block <= %(high)s
+group by rx_address, tx_address;
+"""
+
+
+# value counts are mergeable by addition, which keeps the medians in skew_rssi / skew_snr exact
+receipt_signal_counts_sql = """
+select rx_address as address, witness_signal as value, count(*) as n
+from detailed_receipts
+where block > %(low)s and block <= %(high)s and witness_signal is not null
+group by rx_address, witness_signal;
+"""
+
+
+receipt_snr_counts_sql = """
+select rx_address as address, witness_snr as value, count(*) as n
+from detailed_receipts
+where block > %(low)s and block <= %(high)s and witness_snr is not null
+group by rx_address, witness_snr;
+"""
+
+
+receipt_watermark_sql = """
+select max(block) from detailed_receipts;
+"""
+
+
+receipt_floor_sql = """
+select min(block) from detailed_receipts;
+"""
+
+
+sync_height_sql = """
+select value from follower_info where name = 'sync_height';
+"""
+
+
+gateway_country_sql = """
+select g.address, b.long_country from gateway_inventory g join locations b on g.location = b.location;
+"""
+
+
+# distinct witness edges, optionally split into hash partitions of witness_address so a full-network read
+# doesn't have to come back as one result set
+witness_edges_sql = """
+select distinct transmitter_address, witness_address
+from challenge_receipts_parsed
+where abs(hashtext(witness_address)) %% %(partitions)s = %(partition)s;
+"""
+
+
+# edges added within a block range, for the incremental graph metrics update
+witness_edges_since_sql = """
+select distinct transmitter_address, witness_address
+from challenge_receipts_parsed
+where block > %(low)s and block <= %(high)s;
+"""
+
+
+challenge_watermark_sql = """
+select max(block) from challenge_receipts_parsed;
+"""
+
+
+# 2-hop witness edges around one hotspot
+ego_graph_edges_sql = """
+with a as
+
+    (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address
+     from challenge_receipts_parsed
+     where witness_address = %(address)s),
+
+    b as
+     (select distinct on (transmitter_address, witness_address) transmitter_address, witness_address from
+     challenge_receipts_parsed where witness_address in (select transmitter_address from a)
+    )
+
+    select transmitter_address, witness_address from a
+    union all
+    select transmitter_address, witness_address from b;
+"""
+
+
+# summary tables owned by views.py, so the aggregates are computed once per refresh instead of by every process
+receipt_summary_view_sql = f"""
+create materialized view if not exists receipt_summary as
+{detailed_receipt_sql.strip().rstrip(";")};
+"""
+
+data_transfer_summary_view_sql = f"""
+create materialized view if not exists data_transfer_summary as
+{data_transfer_sql.strip().rstrip(";")};
+"""
+
+# one row per active hotspot: the receipt summary joined with the inventory columns the dataset keeps and data
+# transfer totals, for filtering in the database (sql_filters.py). null aggregates, e.g. the stddev of a single
+# witness, are zeroed like load_dataset's fillna(0)
+_receipt_feature_columns = ["n_witnessed", "total_witnessed", "min_distance", "max_distance", "avg_tx_reward_scale",
+                            "std_tx_reward_scale", "n_denylisted_tx", "r2_rssi_distance", "slope_rssi_distance",
+                            "r2_rssi_snr", "slope_rssi_snr", "skew_rssi", "skew_snr", "same_maker_ratio",
+                            "avg_tx_age_blocks", "std_tx_first_block", "rx_on_denylist"]
+
+hotspot_features_view_sql = f"""
+create materialized view if not exists hotspot_features as
+select
+r.address, r.long_country,
+{", ".join(f"coalesce(r.{c}, 0) as {c}" for c in _receipt_feature_columns)},
+g.name, g.owner, g.location, g.location_hex, g.first_block, g.last_block, g.nonce, g.gain, g.elevation, g.reward_scale,
+g.payer,
+coalesce(d.dcs_transferred, 0) as dcs_transferred,
+coalesce(d.packets_transferred, 0) as packets_transferred
+from receipt_summary r
+join gateway_inventory g on r.address = g.address
+left join data_transfer_summary d on r.address = d.client;
+"""
+
+summary_freshness_table_sql = """
+create table if not exists summary_freshness (
+name text primary key,
+refreshed_at timestamptz not null,
+refresh_seconds float
+);
+"""
+
+record_summary_freshness_sql = """
+insert into summary_freshness (name, refreshed_at, refresh_seconds) values (%(name)s, now(), %(seconds)s)
+on conflict (name) do update set refreshed_at = excluded.refreshed_at, refresh_seconds = excluded.refresh_seconds;
+"""
+
+existing_summaries_sql = """
+select matviewname, ispopulated from pg_matviews where matviewname = any(%(names)s);
+"""
+
+summary_freshness_sql = """
+select name, refreshed_at, refresh_seconds from summary_freshness;
+"""
@@ -0,0 +1,237 @@
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import json
+import os
+import shutil
+from queries import *
+from sqlalchemy.engine import Engine
+from typing import Optional
+
+
+AGGREGATES_DIR = "static/aggregates"
+
+# univariate (n, mean, M2) and regression (n, mx, my, sxx, syy, sxy) moments stored per rx_address
+MOMENTS = ["reward_scale", "signal", "snr", "tx_first_block"]
+REGRESSIONS = ["rssi_distance", "rssi_snr"]
+SUMS = ["total_witnessed", "n_same_maker"]
+
+RESULT_COLUMNS = ["address", "n_witnessed", "total_witnessed", "min_distance", "max_distance", "avg_tx_reward_scale",
+                  "std_tx_reward_scale", "n_denylisted_tx", "r2_rssi_distance", "slope_rssi_distance", "r2_rssi_snr",
+                  "slope_rssi_snr", "skew_rssi", "skew_snr", "same_maker_ratio", "avg_tx_age_blocks",
+                  "std_tx_first_block", "rx_on_denylist", "long_country"]
+
+
+def _path(name: str) -> str:
+    return os.path.join(AGGREGATES_DIR, name)
+
+
+def load_watermark() -> int:
+    if not os.path.exists(_path("watermark.json")):
+        return -1
+    with open(_path("watermark.json")) as f:
+        return json.load(f)["watermark"]
+
+
+def load_floor() -> Optional[int]:
+    # the oldest receipt block when the partials were first built; None for state written before it was recorded
+    if not os.path.exists(_path("watermark.json")):
+        return None
+    with open(_path("watermark.json")) as f:
+        return json.load(f).get("floor")
+
+
+def _merge_moments(a: pd.DataFrame, b: pd.DataFrame, prefix: str) -> pd.DataFrame:
+    # chan et al. parallel update for count / mean / M2
+    na, nb = a[f"{prefix}_n"], b[f"{prefix}_n"]
+    n = na + nb
+    delta = b[f"{prefix}_mean"] - a[f"{prefix}_mean"]
+    w = (nb / n.where(n > 0, 1))
+    return pd.DataFrame({
+        f"{prefix}_n": n,
+        f"{prefix}_mean": a[f"{prefix}_mean"] + delta * w,
+        f"{prefix}_m2": a[f"{prefix}_m2"] + b[f"{prefix}_m2"] + delta ** 2 * na * w,
+    })
+
+
+def _merge_regression(a: pd.DataFrame, b: pd.DataFrame, prefix: str) -> pd.DataFrame:
+    na, nb = a[f"{prefix}_n"], b[f"{prefix}_n"]
+    n = na + nb
+    dx = b[f"{prefix}_mx"] - a[f"{prefix}_mx"]
+    dy = b[f"{prefix}_my"] - a[f"{prefix}_my"]
+    w = (nb / n.where(n > 0, 1))
+    return pd.DataFrame({
+        f"{prefix}_n": n,
+        f"{prefix}_mx": a[f"{prefix}_mx"] + dx * w,
+        f"{prefix}_my": a[f"{prefix}_my"] + dy * w,
+        f"{prefix}_sxx": a[f"{prefix}_sxx"] + b[f"{prefix}_sxx"] + dx * dx * na * w,
+        f"{prefix}_syy": a[f"{prefix}_syy"] + b[f"{prefix}_syy"] + dy * dy * na * w,
+        f"{prefix}_sxy": a[f"{prefix}_sxy"] + b[f"{prefix}_sxy"] + dx * dy * na * w,
+    })
+
+
+def merge_partials(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    old, new = old.set_index("address"), new.set_index("address")
+    index = old.index.union(new.index)
+
+    # addresses missing on one side contribute empty (zero-count) partials
+    a, b = old.reindex(index), new.reindex(index)
+    fill = {c: 0 for c in old.columns if c not in ("min_distance", "max_distance")}
+    a, b = a.fillna(value=fill), b.fillna(value=fill)
+
+    merged = [
+        (a[SUMS] + b[SUMS]),
+        pd.DataFrame({
+            "min_distance": np.fmin(a["min_distance"], b["min_distance"]),
+            "max_distance": np.fmax(a["max_distance"], b["max_distance"]),
+        }),
+    ]
+    merged += [_merge_moments(a, b, m) for m in MOMENTS]
+    merged += [_merge_regression(a, b, r) for r in REGRESSIONS]
+    return pd.concat(merged, axis=1).reset_index()
+
+
+def merge_counts(old: pd.DataFrame, new: pd.DataFrame, keys: list) -> pd.DataFrame:
+    # every non-key column is a count
+    return pd.concat([old, new]).groupby(keys, as_index=False).sum()
+
+
+def _std(n: pd.Series, m2: pd.Series) -> pd.Series:
+    # stddev() is the sample standard deviation and null for a single row
+    return np.sqrt(m2 / (n - 1)).where(n > 1)
+
+
+def _r2(df: pd.DataFrame, prefix: str) -> pd.Series:
+    # same edge cases as postgres regr_r2
+    sxx, syy, sxy = df[f"{prefix}_sxx"], df[f"{prefix}_syy"], df[f"{prefix}_sxy"]
+    r2 = (sxy ** 2 / (sxx * syy)).where(syy != 0, 1.)
+    return r2.where((sxx != 0) & (df[f"{prefix}_n"] > 0))
+
+
+def _slope(df: pd.DataFrame, prefix: str) -> pd.Series:
+    sxx, sxy = df[f"{prefix}_sxx"], df[f"{prefix}_sxy"]
+    return (sxy / sxx).where((sxx != 0) & (df[f"{prefix}_n"] > 0))
+
+
+def median_from_counts(counts: pd.DataFrame) -> pd.Series:
+    # percentile_cont(0.5) from per-address value counts: interpolate between the two middle ranks
+    counts = counts.sort_values(["address", "value"])
+    cum = counts["n"].cumsum().to_numpy()
+    totals = counts.groupby("address", sort=False)["n"].sum()
+    offsets = np.concatenate([[0], np.cumsum(totals.to_numpy())[:-1]])
+
+    position = (totals.to_numpy() - 1) * 0.5
+    lo, hi = np.floor(position), np.ceil(position)
+    values = counts["value"].to_numpy(dtype=float)
+    v_lo = values[np.searchsorted(cum, offsets + lo, side="right")]
+    v_hi = values[np.searchsorted(cum, offsets + hi, side="right")]
+    return pd.Series(v_lo + (v_hi - v_lo) * (position - lo), index=totals.index)
+
+
+def _skew(mean: pd.Series, std: pd.Series, median: pd.Series) -> pd.Series:
+    return (3 * (mean - median) / std).where(std != 0, 0.)
+
+
+def finalize(partials: pd.DataFrame, pairs: pd.DataFrame, signal_counts: pd.DataFrame, snr_counts: pd.DataFrame,
+             sync_height: float, countries: pd.DataFrame) -> pd.DataFrame:
+    df = partials.set_index("address")
+    per_address = pairs.groupby("address")
+
+    signal_std = _std(df["signal_n"], df["signal_m2"])
+    snr_std = _std(df["snr_n"], df["snr_m2"])
+    signal_median = median_from_counts(signal_counts).reindex(df.index)
+    snr_median = median_from_counts(snr_counts).reindex(df.index)
+
+    result = pd.DataFrame({
+        "n_witnessed": per_address.size().reindex(df.index, fill_value=0),
+        "total_witnessed": df["total_witnessed"],
+        "min_distance": df["min_distance"],
+        "max_distance": df["max_distance"],
+        "avg_tx_reward_scale": df["reward_scale_mean"].where(df["reward_scale_n"] > 0),
+        "std_tx_reward_scale": _std(df["reward_scale_n"], df["reward_scale_m2"]),
+        "n_denylisted_tx": per_address["n_denylisted_tx"].sum().reindex(df.index, fill_value=0),
+        "r2_rssi_distance": _r2(df, "rssi_distance"),
+        "slope_rssi_distance": _slope(df, "rssi_distance"),
+        "r2_rssi_snr": _r2(df, "rssi_snr"),
+        "slope_rssi_snr": _slope(df, "rssi_snr"),
+        "skew_rssi": _skew(df["signal_mean"].where(df["signal_n"] > 0), signal_std, signal_median),
+        "skew_snr": _skew(df["snr_mean"].where(df["snr_n"] > 0), snr_std, snr_median),
+        "same_maker_ratio": df["n_same_maker"] / df["total_witnessed"],
+        "avg_tx_age_blocks": (sync_height - df["tx_first_block_mean"]).where(df["tx_first_block_n"] > 0),
+        "std_tx_first_block": _std(df["tx_first_block_n"], df["tx_first_block_m2"]),
+        "rx_on_denylist": (per_address["n_rx_on_denylist"].sum().reindex(df.index, fill_value=0) > 0).astype(int),
+    }).reset_index()
+
+    return result.merge(countries, on="address")[RESULT_COLUMNS]
+
+
+def save_state(state: dict, watermark: int, floor: int):
+    # every partial table and the watermark are written to a sibling directory and swapped in together. tables merged
+    # past the stored watermark are never on disk next to it, so an interrupted run can't fold the same blocks in twice
+    directory = AGGREGATES_DIR.rstrip(os.sep)
+    staging, previous = f"{directory}.tmp", f"{directory}.old"
+    for path in (staging, previous):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(staging)
+    for name, df in state.items():
+        df.to_parquet(os.path.join(staging, f"{name}.parquet"), index=False)
+    with open(os.path.join(staging, "watermark.json"), "w") as f:
+        json.dump({"watermark": watermark, "floor": floor}, f)
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(staging, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def refresh_receipt_aggregates(engine: Engine) -> pd.DataFrame:
+    # fold receipts newer than the last watermark into the stored partials, then finalize into the same table
+    # detailed_receipt_sql returns. the first run (no watermark) aggregates the whole table once. receipts are assumed
+    # to be append-only: if the oldest block in detailed_receipts has moved past the one the partials started from
+    # (a rolling window), expired receipts are still in the partials, so everything is rebuilt instead.
+    tables = {
+        "partials": receipt_partials_sql,
+        "pairs": receipt_pairs_sql,
+        "signal_counts": receipt_signal_counts_sql,
+        "snr_counts": receipt_snr_counts_sql,
+    }
+
+    low = load_watermark()
+    if not all(os.path.exists(_path(f"{name}.parquet")) for name in tables):
+        low = -1
+    floor = engine.execute(receipt_floor_sql).one()[0]
+    if low >= 0 and (load_floor() is None or (floor is not None and floor > load_floor())):
+        print("Receipts older than the stored partials have expired, rebuilding the aggregates...")
+        low = -1
+    # pair tables from before the per-pair receipt and denylist counts can't be merged
+    if low >= 0 and "n_rx_on_denylist" not in pq.read_schema(_path("pairs.parquet")).names:
+        low = -1
+    high = engine.execute(receipt_watermark_sql).one()[0]
+    params = {"low": low, "high": high}
+
+    state = {}
+    for name, sql in tables.items():
+        old = pd.read_parquet(_path(f"{name}.parquet")) if low >= 0 else None
+        if high is None or high <= low:
+            new = None
+        else:
+            print(f"Aggregating {name} for blocks ({low}, {high}]...")
+            new = pd.read_sql(sql, con=engine, params=params)
+
+        if old is None or new is None:
+            state[name] = new if old is None else old
+        elif name == "partials":
+            state[name] = merge_partials(old, new)
+        elif name == "pairs":
+            state[name] = merge_counts(old, new, ["address", "tx_address"])
+        else:
+            state[name] = merge_counts(old, new, ["address", "value"])
+
+    if high is not None and high > low:
+        save_state(state, int(high), int(floor) if low < 0 else load_floor())
+    if any(df is None for df in state.values()):
+        # nothing aggregated yet (an empty detailed_receipts on the first run)
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    sync_height = float(engine.execute(sync_height_sql).one()[0])
+    countries = pd.read_sql(gateway_country_sql, con=engine)
+    return finalize(state["partials"], state["pairs"], state["signal_counts"], state["snr_counts"], sync_height, countries)
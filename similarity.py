@@ -0,0 +1,53 @@
+import pandas as pd
+import numpy as np
+from typing import List, Tuple
+from sklearn.cluster import MiniBatchKMeans
+from clustering import CLUSTER_FEATURES, feature_matrix
+
+
+class SimilarityIndex:
+    # inverted-file index over the standardized CLUSTER_FEATURES: rows are bucketed by their nearest k-means
+    # centroid, and a query only scans the buckets of its n_probe nearest centroids. small datasets, exact=True, or
+    # probes that don't reach k candidates fall back to a brute-force scan
+
+    def __init__(self, dataset: pd.DataFrame, features: List[str] = CLUSTER_FEATURES, n_lists: int = None,
+                 brute_force_below: int = 20000, random_state: int = 0):
+        self.features = [f for f in features if f in dataset.columns or (f == "transferred_data" and "packets_transferred" in dataset.columns)]
+        X = feature_matrix(dataset, self.features)
+        complete = np.isfinite(X).all(axis=1)
+
+        mean, std = X[complete].mean(axis=0), X[complete].std(axis=0)
+        self.vectors = ((X - mean) / np.where(std > 0, std, 1)).astype(np.float32)
+        self.rows = np.flatnonzero(complete).astype(np.int32)
+        self.brute_force_below = brute_force_below
+
+        self.centroids = None
+        if len(self.rows) >= brute_force_below:
+            n_lists = n_lists or int(np.sqrt(len(self.rows)))
+            kmeans = MiniBatchKMeans(n_lists, batch_size=4096, n_init=3, random_state=random_state).fit(self.vectors[self.rows])
+            self.centroids = kmeans.cluster_centers_.astype(np.float32)
+            # rows grouped by list, with offsets[i]:offsets[i + 1] the members of list i
+            order = np.argsort(kmeans.labels_, kind="stable")
+            self.lists = self.rows[order]
+            self.offsets = np.concatenate([[0], np.cumsum(np.bincount(kmeans.labels_, minlength=n_lists))])
+
+    def _nearest(self, candidates: np.ndarray, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        distances = ((self.vectors[candidates] - query) ** 2).sum(axis=1)
+        k = min(k, len(candidates))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind="stable")]
+        return candidates[top], np.sqrt(distances[top])
+
+    def query(self, position: int, k: int = 50, n_probe: int = 32, exact: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        # the k rows closest to row `position` (itself included, at distance 0), as (row positions, distances)
+        query = self.vectors[position]
+        if not np.isfinite(query).all():
+            return np.array([], dtype=np.int32), np.array([])
+        if exact or self.centroids is None:
+            return self._nearest(self.rows, query, k)
+
+        probes = np.argsort(((self.centroids - query) ** 2).sum(axis=1))[:n_probe]
+        candidates = np.concatenate([self.lists[self.offsets[i]:self.offsets[i + 1]] for i in probes])
+        if len(candidates) < k:
+            return self._nearest(self.rows, query, k)
+        return self._nearest(candidates, query, k)
@@ -0,0 +1,215 @@
+import pandas as pd
+import numpy as np
+from typing import List, Optional
+from sqlalchemy.engine import Engine
+from filters import Filters, FilterPlan, spatial_clauses
+from dataset_cache import apply_schema
+from denylist import DenylistStore, release_membership, denied_in_releases, first_denied_after
+from geo import add_lat_lon, parent_cells
+from clustering import label_dataset
+from views import summary_freshness
+from lru import LRUCache
+
+
+# database-side execution of Filters over the hotspot_features materialized view (see views.py), for today's numbers without
+# rebuilding the daily cache. only matching rows are transferred; the result has the same columns as the dataset
+# filter_dataset runs on
+FEATURES_VIEW = "hotspot_features"
+
+# view columns load_dataset's dropna can drop rows on (the receipt aggregates are coalesced in the view). together with
+# the makers join they define the population filter_dataset's percentiles are taken over
+POPULATION_COLUMNS = ["long_country", "name", "owner", "location", "location_hex", "first_block", "last_block", "nonce",
+                      "gain", "elevation", "reward_scale"]
+
+
+class SqlPlan:
+    # where clauses plus their bound parameters (psycopg2 pyformat), the percentiles they reference, and the population
+    # conditions both the percentiles and the result are restricted to
+    def __init__(self):
+        self.where = []
+        self.params = {}
+        self.percentiles = []
+        self.population = []
+
+    def param(self, value) -> str:
+        name = f"p{len(self.params)}"
+        self.params[name] = value
+        return f"%({name})s"
+
+    def percentile(self, column: str, q: float) -> str:
+        # percentile over the population rows of the view, same as np.percentile's linear method
+        name = f"q{len(self.percentiles)}"
+        self.percentiles.append(f"percentile_cont({self.param(q / 100)}) within group (order by {column}) as {name}")
+        return f"p.{name}"
+
+    def between(self, column: str, low: str, high: str):
+        self.where.append(f"f.{column} between {low} and {high}")
+
+    def compare(self, column: str, op: str, value):
+        self.where.append(f"f.{column} {op} {self.param(value)}")
+
+    def sql(self, view: str = FEATURES_VIEW) -> str:
+        population = " and ".join(self.population) if self.population else "true"
+        percentiles = f"with p as (select {', '.join(self.percentiles)} from {view} f where {population})\n" \
+            if self.percentiles else ""
+        source = f"{view} f, p" if self.percentiles else f"{view} f"
+        where = "\nand ".join(self.population + self.where)
+        return f"{percentiles}select f.* from {source}\nwhere {where or 'true'};"
+
+    def counts_sql(self, column: str, view: str = FEATURES_VIEW) -> str:
+        # population rows per distinct value of `column`
+        population = " and ".join(self.population) if self.population else "true"
+        return f"select f.{column}, count(*) as n from {view} f where {population} group by f.{column};"
+
+
+def population_plan(makers: pd.DataFrame) -> SqlPlan:
+    # the rows load_dataset keeps: a known maker and no missing inventory columns
+    plan = SqlPlan()
+    plan.population.append(f"f.payer = any({plan.param(list(makers['address']))})")
+    plan.population += [f"f.{column} is not null" for column in POPULATION_COLUMNS]
+    return plan
+
+
+# hotspots per parent hex over the view's population, keyed by (last refresh of the view, resolution). postgres has no
+# h3 functions, so rows are counted per location there and rolled up to parent hexes here, once per refresh
+_hex_density_cache = LRUCache(max_entries=16)
+
+
+def hex_density(engine: Engine, makers: pd.DataFrame, resolution: int) -> pd.Series:
+    freshness = summary_freshness(engine)
+    key = (freshness.loc[FEATURES_VIEW, "refreshed_at"], resolution) if FEATURES_VIEW in freshness.index else None
+    counts = _hex_density_cache.get(key) if key is not None else None
+    if counts is None:
+        plan = population_plan(makers)
+        locations = pd.read_sql(plan.counts_sql("location"), con=engine, params=plan.params)
+        counts = locations.groupby(parent_cells(locations["location"], resolution))["n"].sum()
+        if key is not None:
+            _hex_density_cache.put(key, counts)
+    return counts
+
+
+def compile_sql_filters(filters: Filters, makers: pd.DataFrame, denylist_releases: dict) -> SqlPlan:
+    # mirrors filters.compile_filters clause for clause. makers are matched on payer, and denylist history is
+    # resolved to address lists from the local release store
+    plan = population_plan(makers)
+
+    def percentile_range(column, percentile_range):
+        plan.between(column, plan.percentile(column, percentile_range[0]), plan.percentile(column, percentile_range[1]))
+
+    def value_range(column, value_range):
+        plan.between(column, plan.param(value_range[0]), plan.param(value_range[1]))
+
+    def any_of(column, values):
+        plan.where.append(f"f.{column} = any({plan.param(list(values))})")
+
+    if "All" not in filters.makers:
+        any_of("payer", makers.loc[makers["name"].isin(filters.makers), "address"])
+    if "All" not in filters.countries:
+        any_of("long_country", filters.countries)
+
+    if filters.data_transfer_opts == "Data Transferring Hotspots ONLY":
+        plan.compare("packets_transferred", ">", 0)
+    if filters.data_transfer_opts == "NO Data Transferring Hotspots ONLY":
+        plan.compare("packets_transferred", "=", 0)
+    if filters.data_transfer_opts == "Custom Range":
+        percentile_range("packets_transferred", filters.data_transfer_range)
+    else:
+        # outside of "Custom Range" the upper bound has always been True (== 1)
+        plan.between("packets_transferred", plan.percentile("packets_transferred", filters.data_transfer_range[0]), plan.param(1))
+
+    if filters.n_witnessed_range:
+        percentile_range("n_witnessed", filters.n_witnessed_range)
+    if filters.total_witnessed_range:
+        percentile_range("total_witnessed", filters.total_witnessed_range)
+
+    value_range("min_distance", (filters.min_distance_min, filters.min_distance_max))
+    value_range("max_distance", (filters.max_distance_min, filters.max_distance_max))
+
+    if filters.perfect_reward_scale_only is True:
+        plan.compare("avg_tx_reward_scale", ">", 0.999)
+    if filters.perfect_reward_scale_only is False:
+        value_range("avg_tx_reward_scale", filters.avg_tx_reward_scale_range)
+        value_range("std_tx_reward_scale", filters.std_tx_reward_scale_range)
+
+    if filters.witnesses_denylisted_tx:
+        plan.compare("n_denylisted_tx", ">", 0)
+    if filters.same_maker_only:
+        plan.compare("same_maker_ratio", ">", 0.999)
+    if filters.avg_tx_age_blocks_range:
+        value_range("avg_tx_age_blocks", filters.avg_tx_age_blocks_range)
+    if filters.std_tx_age_blocks_range:
+        value_range("std_tx_first_block", filters.std_tx_age_blocks_range)
+    if filters.reasserted_hotspots_only:
+        plan.compare("nonce", ">", 1)
+    if filters.gain_range:
+        value_range("gain", filters.gain_range)
+    if filters.elevation_range:
+        percentile_range("elevation", filters.elevation_range)
+
+    if filters.on_current_denylist:
+        plan.compare("rx_on_denylist", "=", 1)
+    if filters.previously_denied or filters.never_denied:
+        plan.compare("rx_on_denylist", "=", 0)
+    if filters.on_any_denylist or filters.previously_denied:
+        any_of("address", set().union(*denylist_releases.values()))
+
+    if filters.denied_release_range is not None or filters.first_denied_after is not None:
+        # evaluate the release bitsets over every listed address, then push the survivors down
+        listed = pd.Series(sorted(set().union(*denylist_releases.values())), dtype=object)
+        bits = release_membership(listed, denylist_releases).to_numpy()
+        keep = np.ones(len(listed), dtype=bool)
+        if filters.denied_release_range is not None:
+            keep &= denied_in_releases(bits, *filters.denied_release_range)
+        if filters.first_denied_after is not None:
+            keep &= first_denied_after(bits, filters.first_denied_after)
+        any_of("address", listed[keep])
+
+    if filters.first_block_max:
+        plan.compare("first_block", "<", filters.first_block_max)
+    if filters.first_block_min:
+        plan.compare("first_block", ">", filters.first_block_min)
+
+    return plan
+
+
+def sql_filter_dataset(engine: Engine, filters: Filters, columns: Optional[List[str]] = None,
+                       makers_path: str = "static/makers.csv", denylist: Optional[DenylistStore] = None,
+                       release_tags: Optional[List[str]] = None) -> pd.DataFrame:
+    makers = pd.read_csv(makers_path)
+    denylist_releases = (denylist or DenylistStore.from_env()).releases()
+    if release_tags:
+        # release indices in the filters refer to the daily cache's bit order (see loaders.load_denylist_tags)
+        denylist_releases = {tag: denylist_releases[tag] for tag in release_tags}
+    plan = compile_sql_filters(filters, makers, denylist_releases)
+    result = pd.read_sql(plan.sql(), con=engine, params=plan.params)
+
+    # the rest of load_dataset's post-processing, on matching rows only
+    dataset = result.merge(makers, left_on="payer", right_on="address", suffixes=("_gateway", "_maker")). \
+        drop(["Unnamed: 0", "payer"], axis=1).dropna()
+    dataset["slope_rssi_distance"] = dataset["slope_rssi_distance"].clip(-10, 10)
+
+    membership = release_membership(dataset["address_gateway"], denylist_releases)
+    dataset = pd.concat([dataset, membership], axis=1)
+    dataset["denied_at_some_point"] = membership.to_numpy().any(axis=1)
+
+    # cluster labels only exist locally, so that predicate runs on the fetched rows
+    labels = label_dataset(dataset)
+    if labels is not None:
+        dataset["cluster"] = labels
+        if filters.clusters is not None:
+            dataset = dataset[dataset["cluster"].isin(filters.clusters)]
+    dataset = add_lat_lon(dataset).reset_index(drop=True)
+
+    # radius and k-ring need coordinates, so they run on the fetched rows. hex density counts every hotspot of the
+    # population, like H3Index.dense_rows does over the loaded dataset, not just the matching rows
+    local = spatial_clauses(filters.copy(update={"min_hex_density": None}), dataset)
+    dataset = FilterPlan(local, len(dataset)).execute(dataset) if local else dataset
+    if filters.min_hex_density is not None:
+        counts = hex_density(engine, makers, filters.hex_density_resolution)
+        density = pd.Series(parent_cells(dataset["location"], filters.hex_density_resolution)).map(counts).fillna(0)
+        dataset = dataset[density.to_numpy() >= filters.min_hex_density]
+    dataset = apply_schema(dataset)
+
+    if columns is not None:
+        dataset = dataset[[c for c in columns if c in dataset.columns]]
+    return dataset.reset_index(drop=True)
@@ -0,0 +1,101 @@
+import pandas as pd
+import numpy as np
+import warnings
+from typing import List
+
+
+# features compared between the filtered subset and the baseline in app.py
+COMPARISON_FEATURES = ["n_witnessed", "med_distance", "avg_tx_reward_scale", "same_maker_ratio", "avg_tx_age_blocks",
+                       "std_tx_first_block", "r2_rssi_distance", "slope_rssi_distance", "r2_rssi_snr", "slope_rssi_snr",
+                       "packets_transferred"]
+
+QUANTILES = [2.5, 25, 50, 75, 97.5]
+
+
+class SelectionStats:
+    # per-feature summary of one row selection; every array is indexed by feature
+    def __init__(self, features: List[str], edges: np.ndarray, counts: np.ndarray, n: np.ndarray, n_positive: np.ndarray,
+                 mean: np.ndarray, var: np.ndarray, quantiles: np.ndarray, minimum: np.ndarray, maximum: np.ndarray):
+        self.features = features
+        self.position = {f: i for i, f in enumerate(features)}
+        self.edges = edges
+        self.counts = counts
+        self.n = n
+        self.n_positive = n_positive
+        self.mean = mean
+        self.var = var
+        self.std = np.sqrt(var)
+        self.quantiles = quantiles
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __contains__(self, feature: str) -> bool:
+        return feature in self.position
+
+    def share_positive(self, feature: str) -> float:
+        # share of the selection with feature > 0, e.g. hotspots that transferred any data
+        i = self.position[feature]
+        return self.n_positive[i] / self.n[i] if self.n[i] > 0 else np.nan
+
+    def quantile(self, feature: str, q: float) -> float:
+        return self.quantiles[QUANTILES.index(q), self.position[feature]]
+
+    def box(self, feature: str) -> dict:
+        # box plot statistics; fences are the tukey fences clamped to the observed range
+        i = self.position[feature]
+        q1, median, q3 = (self.quantile(feature, q) for q in (25, 50, 75))
+        iqr = q3 - q1
+        return dict(q1=[q1], median=[median], q3=[q3], lowerfence=[max(q1 - 1.5 * iqr, self.minimum[i])],
+                    upperfence=[min(q3 + 1.5 * iqr, self.maximum[i])])
+
+    def zscores(self, baseline: "SelectionStats") -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.mean - baseline.mean) / baseline.std
+
+
+class StatsEngine:
+    # feature matrix and fixed histogram bin edges taken from the full dataset once. summarize() gathers a selection's
+    # rows a single time and computes histograms, moments and quantiles for every feature together
+
+    def __init__(self, dataset: pd.DataFrame, features: List[str] = COMPARISON_FEATURES, bins: int = 50):
+        self.features = [f for f in features if f in dataset.columns]
+        self.matrix = dataset[self.features].to_numpy(dtype=float)
+        self.bins = bins
+
+        finite = np.where(np.isfinite(self.matrix), self.matrix, np.nan)
+        low, high = np.nanmin(finite, axis=0), np.nanmax(finite, axis=0)
+        high = np.where(high > low, high, low + 1)
+        self.edges = np.linspace(low, high, bins + 1, axis=1)
+
+    def summarize(self, positions: np.ndarray) -> SelectionStats:
+        return self._summarize(self.matrix[positions])
+
+    def summarize_frame(self, df: pd.DataFrame) -> SelectionStats:
+        # rows that aren't part of the dataset (e.g. live query results), binned against the same edges. values outside
+        # the dataset's range land in the end bins
+        return self._summarize(df[self.features].to_numpy(dtype=float))
+
+    def _summarize(self, rows: np.ndarray) -> SelectionStats:
+        valid = np.isfinite(rows)
+        n = valid.sum(axis=0)
+        n_positive = (valid & (np.where(valid, rows, 0) > 0)).sum(axis=0)
+
+        # histograms for all features with one bincount: bin index offset by feature
+        # (searchsorted against the edges so bin boundaries match np.histogram exactly)
+        bin_index = np.empty(rows.shape, dtype=np.int64)
+        for i in range(len(self.features)):
+            bin_index[:, i] = np.searchsorted(self.edges[i], rows[:, i], side="right") - 1
+        np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+        flat = (bin_index + np.arange(len(self.features)) * self.bins)[valid]
+        counts = np.bincount(flat, minlength=len(self.features) * self.bins).reshape(len(self.features), self.bins)
+
+        # empty selections and all-nan features summarize to nan rather than raising
+        clean = np.where(valid, rows, np.nan) if len(rows) else np.full((1, len(self.features)), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = np.nanmean(clean, axis=0)
+            var = np.nanvar(clean, axis=0, ddof=1)
+            quantiles = np.nanpercentile(clean, QUANTILES, axis=0)
+            minimum, maximum = np.nanmin(clean, axis=0), np.nanmax(clean, axis=0)
+
+        return SelectionStats(self.features, self.edges, counts, n, n_positive, mean, var, quantiles, minimum, maximum)
@@ -0,0 +1,105 @@
+import pandas as pd
+from sqlalchemy.engine import create_engine, Engine
+from sqlalchemy.exc import DBAPIError
+import argparse
+import os
+import time
+from dotenv import load_dotenv
+from queries import *
+
+
+# materialized summaries in dependency order, as (name, create statement, unique key). the unique index is what
+# lets postgres refresh a view concurrently, i.e. without blocking readers
+SUMMARY_VIEWS = [
+    ("receipt_summary", receipt_summary_view_sql, "address"),
+    ("data_transfer_summary", data_transfer_summary_view_sql, "client"),
+    ("hotspot_features", hotspot_features_view_sql, "address"),
+]
+
+# indexes on the source tables for the per-hotspot lookups and group bys
+SOURCE_INDEXES = [
+    ("detailed_receipts", "rx_address"),
+    ("data_credits", "client"),
+]
+
+
+def _execute(engine: Engine, sql: str, params: dict = None) -> bool:
+    try:
+        engine.execute(sql, params) if params else engine.execute(sql)
+        return True
+    except DBAPIError as e:
+        print(f"Failed: {sql.strip().splitlines()[0]} ({e.orig})")
+        return False
+
+
+def existing_views(engine: Engine, names: list) -> pd.DataFrame:
+    # the materialized views among `names` that exist, indexed by name, with whether they've been populated
+    try:
+        return pd.read_sql(existing_summaries_sql, con=engine, params={"names": list(names)}, index_col="matviewname")
+    except DBAPIError:
+        return pd.DataFrame(columns=["ispopulated"])
+
+
+def create_views(engine: Engine):
+    # idempotent: creates (and populates) whatever doesn't exist yet
+    for table, column in SOURCE_INDEXES:
+        _execute(engine, f"create index if not exists {table}_{column}_idx on {table} ({column});")
+    _execute(engine, summary_freshness_table_sql)
+
+    existing = existing_views(engine, [name for name, _, _ in SUMMARY_VIEWS])
+    for name, sql, key in SUMMARY_VIEWS:
+        start = time.perf_counter()
+        # a view that failed to create must not be recorded as fresh, or the loaders would try to read it
+        if not _execute(engine, sql):
+            continue
+        _execute(engine, f"create unique index if not exists {name}_{key}_idx on {name} ({key});")
+        # creating an existing view is a no-op, so its freshness is only ever recorded by refresh_views
+        if name in existing.index:
+            print(f"{name} already exists.")
+            continue
+        _execute(engine, record_summary_freshness_sql, {"name": name, "seconds": time.perf_counter() - start})
+        print(f"Created {name}.")
+
+
+def refresh_views(engine: Engine, concurrently: bool = True):
+    # concurrent refreshes keep the old contents readable while the new ones are computed. a view that was never
+    # populated can't be refreshed concurrently, so that falls back to a plain refresh
+    for name, _, _ in SUMMARY_VIEWS:
+        start = time.perf_counter()
+        refreshed = concurrently and _execute(engine, f"refresh materialized view concurrently {name};")
+        if not refreshed and not _execute(engine, f"refresh materialized view {name};"):
+            continue
+        seconds = time.perf_counter() - start
+        _execute(engine, record_summary_freshness_sql, {"name": name, "seconds": seconds})
+        print(f"Refreshed {name} in {seconds:.1f}s.")
+
+
+def summary_freshness(engine: Engine) -> pd.DataFrame:
+    # one row per refreshed summary; empty if the summaries were never created
+    try:
+        return pd.read_sql(summary_freshness_sql, con=engine, index_col="name")
+    except DBAPIError:
+        return pd.DataFrame(columns=["refreshed_at", "refresh_seconds"])
+
+
+def summaries_available(engine: Engine, names: list) -> bool:
+    # the views have to exist and have been populated at least once; the freshness table alone isn't proof of either
+    populated = existing_views(engine, names)["ispopulated"]
+    freshness = summary_freshness(engine)
+    return all(populated.get(name, False) and name in freshness.index for name in names)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Manage the materialized summary views the loaders read from.")
+    parser.add_argument("--create", action="store_true", help="create missing views, their indexes and the freshness table")
+    parser.add_argument("--refresh", action="store_true", help="recompute every view, in dependency order")
+    parser.add_argument("--blocking", action="store_true", help="refresh without CONCURRENTLY (faster, but blocks readers)")
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv("POSTGRES_CONNECTION_STRING"))
+    if args.create:
+        create_views(engine)
+    if args.refresh:
+        refresh_views(engine, concurrently=not args.blocking)
+    print(summary_freshness(engine))
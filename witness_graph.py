@@ -0,0 +1,243 @@
+import networkx as nx
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import os
+import json
+import shutil
+from sqlalchemy.engine import Engine
+from typing import List, Union
+from queries import witness_edges_sql, witness_edges_since_sql
+from cliques import largest_clique_containing
+
+
+def load_witness_edges(engine: Engine, partitions: int = 1) -> pd.DataFrame:
+    # one bulk read of the distinct (transmitter, witness) edge list, in hash partitions of witness_address
+    chunks = []
+    for partition in range(partitions):
+        chunks.append(pd.read_sql(witness_edges_sql, con=engine, params={"partitions": partitions, "partition": partition}))
+        print(f"{partition + 1} / {partitions} edge partitions loaded.")
+    return pd.concat(chunks, ignore_index=True)
+
+
+class WitnessGraph:
+    # array-backed witness graph. addresses map to integer ids; `witnessed` is a CSR matrix whose row i lists the
+    # transmitters hotspot i has witnessed (the first hop of its 2-hop graph) and `undirected` is its symmetric closure.
+    # self-witness edges are dropped.
+
+    def __init__(self, addresses: np.ndarray, witnessed: sp.csr_matrix, undirected: sp.csr_matrix):
+        self.addresses = addresses
+        self.index = pd.Index(addresses) if addresses is not None else None
+        self.n = witnessed.shape[0]
+        self.witnessed = witnessed
+        self.undirected = undirected
+
+    @classmethod
+    def from_edges(cls, edges: pd.DataFrame) -> "WitnessGraph":
+        codes, addresses = pd.factorize(pd.concat([edges["witness_address"], edges["transmitter_address"]], ignore_index=True))
+        witness, transmitter = codes[:len(edges)], codes[len(edges):]
+        keep = witness != transmitter
+        witness, transmitter = witness[keep], transmitter[keep]
+        n = len(addresses)
+
+        ones = np.ones(len(witness), dtype=np.int32)
+        witnessed = sp.csr_matrix((ones, (witness, transmitter)), shape=(n, n))
+        witnessed.data[:] = 1  # duplicate edges are summed on construction
+        undirected = (witnessed + witnessed.T).tocsr()
+        undirected.data[:] = 1
+        return cls(np.asarray(addresses), witnessed, undirected)
+
+    def save(self, directory: str):
+        # plain .npy arrays so worker processes can memory-map the graph instead of receiving a pickled copy
+        os.makedirs(directory, exist_ok=True)
+        for name in ("witnessed", "undirected"):
+            matrix = getattr(self, name)
+            for part in ("data", "indices", "indptr"):
+                np.save(os.path.join(directory, f"{name}_{part}.npy"), getattr(matrix, part))
+        with open(os.path.join(directory, "addresses.txt"), "w") as f:
+            f.write("\n".join(self.addresses))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True, with_addresses: bool = True) -> "WitnessGraph":
+        mode = "r" if mmap else None
+        matrices = {}
+        for name in ("witnessed", "undirected"):
+            data, indices, indptr = (np.load(os.path.join(directory, f"{name}_{part}.npy"), mmap_mode=mode)
+                                     for part in ("data", "indices", "indptr"))
+            n = len(indptr) - 1
+            matrices[name] = sp.csr_matrix((data, indices, indptr), shape=(n, n), copy=False)
+
+        addresses = None
+        if with_addresses:
+            with open(os.path.join(directory, "addresses.txt")) as f:
+                addresses = np.array(f.read().split("\n"), dtype=object)
+        return cls(addresses, matrices["witnessed"], matrices["undirected"])
+
+    def edges(self) -> pd.DataFrame:
+        coo = self.witnessed.tocoo()
+        return pd.DataFrame({"transmitter_address": self.addresses[coo.col], "witness_address": self.addresses[coo.row]})
+
+    def witnessed_by(self, node: int) -> np.ndarray:
+        # hotspots that have `node` in their first hop
+        return self.witnessed_csc.indices[self.witnessed_csc.indptr[node]:self.witnessed_csc.indptr[node + 1]]
+
+    @property
+    def witnessed_csc(self) -> sp.csc_matrix:
+        if getattr(self, "_witnessed_csc", None) is None:
+            self._witnessed_csc = self.witnessed.tocsc()
+        return self._witnessed_csc
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.index
+
+    def ids(self, addresses: Union[List[str], np.ndarray]) -> np.ndarray:
+        return self.index.get_indexer(addresses)
+
+    def first_hop(self, node: int) -> np.ndarray:
+        return self.witnessed.indices[self.witnessed.indptr[node]:self.witnessed.indptr[node + 1]]
+
+    def degree(self) -> np.ndarray:
+        # degree of each hotspot in its own 2-hop graph == number of distinct transmitters it witnessed
+        return np.diff(self.witnessed.indptr)
+
+    def triangles(self, nodes: np.ndarray = None, block_size: int = 10000) -> np.ndarray:
+        # undirected edges among each node's first hop: diag(A U A^T) / 2, computed in row blocks to bound the
+        # size of the intermediate A @ U product
+        nodes = np.arange(self.n) if nodes is None else np.asarray(nodes)
+        counts = np.zeros(len(nodes), dtype=np.int64)
+        for start in range(0, len(nodes), block_size):
+            rows = self.witnessed[nodes[start:start + block_size]]
+            paths = (rows @ self.undirected).multiply(rows)
+            counts[start:start + block_size] = np.asarray(paths.sum(axis=1)).ravel() // 2
+        return counts
+
+    def clustering(self, nodes: np.ndarray = None) -> np.ndarray:
+        # same as nx.clustering on each node's 2-hop graph: 2T / (d (d - 1)), 0 for degree < 2
+        nodes = np.arange(self.n) if nodes is None else np.asarray(nodes)
+        degree = self.degree()[nodes].astype(float)
+        possible = degree * (degree - 1)
+        triangles = self.triangles(nodes)
+        return np.divide(2 * triangles, possible, out=np.zeros(len(nodes)), where=possible > 0)
+
+    def ego_graph(self, address: str) -> nx.Graph:
+        # same 2-hop graph as the per-address query: the transmitters this hotspot witnessed, plus the transmitters
+        # each of those witnessed
+        G = nx.Graph()
+        if address not in self:
+            return G
+        root = self.ids([address])[0]
+        first_hop = self.first_hop(root)
+        G.add_edges_from((self.addresses[t], address) for t in first_hop)
+        for witness in first_hop:
+            G.add_edges_from((self.addresses[t], self.addresses[witness]) for t in self.first_hop(witness))
+        return G
+
+
+def calculate_graph_metrics(graph: WitnessGraph, address: str, clique_time_budget: float = None):
+    if address not in graph:
+        return None
+    node = graph.ids([address])[0]
+    if graph.degree()[node] == 0:
+        return None
+
+    clique, exact = largest_clique_containing(graph, node, clique_time_budget)
+    return {"address": address,
+            "largest_clique": len(clique),
+            "largest_clique_exact": exact,
+            "clustering_coefficient": graph.clustering([node])[0],
+            "in_degree": int(graph.degree()[node])}
+
+
+def batch_graph_metrics(graph: WitnessGraph, addresses: List[str], clique_time_budget: float = None) -> List[dict]:
+    addresses = [a for a in addresses if a in graph]
+    nodes = graph.ids(addresses)
+
+    # degree and clustering come straight from the CSR arrays for every address at once
+    degree = graph.degree()[nodes]
+    clustering = graph.clustering(nodes)
+
+    results = []
+    for i, (address, node) in enumerate(zip(addresses, nodes)):
+        if degree[i] == 0:
+            continue
+
+        clique, exact = largest_clique_containing(graph, node, clique_time_budget)
+        results.append({"address": address,
+                        "largest_clique": len(clique),
+                        "largest_clique_exact": exact,
+                        "clustering_coefficient": clustering[i],
+                        "in_degree": int(degree[i])})
+
+        if i % 1000 == 0:
+            print(f"{i} / {len(addresses)} graphs complete.")
+    return results
+
+
+def affected_by_new_edges(old: WitnessGraph, new: WitnessGraph, new_edges: pd.DataFrame) -> np.ndarray:
+    # node ids (in `new`) whose 2-hop metrics can change: witnesses that gained a transmitter (degree / first hop), and
+    # every hotspot whose first hop contains both ends of a newly connected pair (triangles / clustering / cliques)
+    witness = new.ids(new_edges["witness_address"])
+    transmitter = new.ids(new_edges["transmitter_address"])
+    keep = witness != transmitter
+    witness, transmitter = witness[keep], transmitter[keep]
+
+    old_witness = old.index.get_indexer(new.addresses[witness])
+    old_transmitter = old.index.get_indexer(new.addresses[transmitter])
+    known = (old_witness >= 0) & (old_transmitter >= 0)
+    was_witnessed = np.zeros(len(witness), dtype=bool)
+    was_adjacent = np.zeros(len(witness), dtype=bool)
+    if known.any():
+        was_witnessed[known] = np.asarray(old.witnessed[old_witness[known], old_transmitter[known]]).ravel() > 0
+        was_adjacent[known] = np.asarray(old.undirected[old_witness[known], old_transmitter[known]]).ravel() > 0
+
+    affected = set(witness[~was_witnessed])
+    for u, v in zip(witness[~was_adjacent], transmitter[~was_adjacent]):
+        affected.update(np.intersect1d(new.witnessed_by(u), new.witnessed_by(v), assume_unique=True))
+    return np.array(sorted(affected), dtype=int)
+
+
+def update_graph_metrics(graph: WitnessGraph, metrics: pd.DataFrame, new_edges: pd.DataFrame,
+                         clique_time_budget: float = None, include_new: bool = False):
+    # fold new edges into the graph and recompute metrics only where they can have changed. returns the merged graph
+    # and the updated metrics frame (same columns as batch_graph_metrics). by default only hotspots already in
+    # `metrics` are recomputed, so a sampled output stays a sample; include_new also adds newly affected hotspots
+    updated = WitnessGraph.from_edges(pd.concat([graph.edges(), new_edges[["transmitter_address", "witness_address"]]], ignore_index=True))
+    affected = affected_by_new_edges(graph, updated, new_edges)
+    addresses = updated.addresses[affected]
+    if not include_new:
+        addresses = addresses[np.isin(addresses, metrics["address"])]
+    print(f"{len(new_edges)} new edges affect {len(addresses)} hotspots.")
+
+    recomputed = pd.DataFrame(batch_graph_metrics(updated, list(addresses), clique_time_budget))
+    if recomputed.empty:
+        return updated, metrics
+    metrics = metrics[~metrics["address"].isin(recomputed["address"])]
+    return updated, pd.concat([metrics, recomputed], ignore_index=True)
+
+
+def save_graph_watermark(directory: str, block: int):
+    with open(os.path.join(directory, "watermark.json"), "w") as f:
+        json.dump({"watermark": int(block)}, f)
+
+
+def load_graph_watermark(directory: str) -> int:
+    with open(os.path.join(directory, "watermark.json")) as f:
+        return json.load(f)["watermark"]
+
+
+def commit_graph(graph: WitnessGraph, directory: str, block: int):
+    # graph and watermark are written to a sibling directory and swapped in together, so an interrupted save leaves
+    # the previous graph and its watermark in place
+    staging, previous = f"{directory.rstrip(os.sep)}.tmp", f"{directory.rstrip(os.sep)}.old"
+    for path in (staging, previous):
+        shutil.rmtree(path, ignore_errors=True)
+    graph.save(staging)
+    save_graph_watermark(staging, block)
+    if os.path.exists(directory):
+        os.rename(directory, previous)
+    os.rename(staging, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def load_new_witness_edges(engine: Engine, low: int, high: int) -> pd.DataFrame:
+    return pd.read_sql(witness_edges_since_sql, con=engine, params={"low": low, "high": high})